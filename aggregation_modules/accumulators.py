@@ -0,0 +1,597 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+running accumulators used to aggregate the input data
+one chunk at a time, accumulators of the same interval
+can be merged, say from different files
+
+the running state of an accumulator, its partial state, can be
+serialized along with the result of the interval and merged with
+the partial states of the same interval from other files
+"""
+
+import base64
+import json
+import logging
+import math
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from aggregation_modules import custom_functions
+from aggregation_modules.interval_context import IntervalContext
+from aggregation_modules.sketches import HyperLogLog, SpaceSaving, TDigest
+
+logger = logging.getLogger(__name__)
+
+# partial state of each basic aggregate function,
+# that is merged and then finalized into the aggregate
+#   count:     number of values
+#   sum:       sum of values
+#   min, max:  min and max of values
+#   any:       any of values is true
+#   moments:   count, mean and sum of squared differences from the mean,
+#              merged with the parallel Welford update, for variance
+#   distribution: counts of distinct values, for the exact median
+#   unique_counts: counts of distinct values, or the Space-Saving
+#              sketch of the most frequent values with top-k
+#   quantiles: t-digest sketch of the values, for the quantile
+#              functions, say p95, see QUANTILE_STATES
+BASE_AGGREGATE_STATES = {
+    "count": ["count"],
+    "sum": ["sum"],
+    "mean": ["sum", "count"],
+    "min": ["min"],
+    "max": ["max"],
+    "any": ["any"],
+    "variance": ["moments"],
+    "median": ["distribution"],
+    "unique_counts": ["unique_counts"],
+}
+
+# partial state of the quantile functions, say p50, p95, p99
+QUANTILE_STATES = ["quantiles"]
+
+
+def get_json_value(value):
+    """
+    returns numpy scalars as python values, for json.dumps
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"not JSON serializable: {type(value)}")
+
+
+def get_counts_state(counts) -> dict:
+    """
+    returns the values and counts lists of the counts dict or Series,
+    that keeps the type of the values, say int status codes
+    """
+    if isinstance(counts, pd.Series):
+        return {"values": counts.index.tolist(), "counts": counts.tolist()}
+    return {"values": list(counts.keys()), "counts": list(counts.values())}
+
+
+def merge_counts(total, counts) -> dict:
+    """
+    adds the values of counts dict into total dict,
+    nested dicts are merged recursively
+    """
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            merge_counts(total.setdefault(key, {}), value)
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+class ColumnAccumulator:
+    """
+    running state of the basic aggregates of a single column
+    """
+
+    def __init__(self, column, funcs, top_k=None, quantile_compression=100):
+        self.column = column
+        self.funcs = funcs
+        # number of most frequent values kept for unique_counts
+        self.top_k = top_k
+        # quantile functions, say p95
+        self.quantiles = [
+            function for function in funcs
+            if custom_functions.get_quantile(function) is not None
+        ]
+
+        self.count = 0
+        self.total = 0
+        self.minimum = math.nan
+        self.maximum = math.nan
+        self.any = False
+
+        # running mean and sum of squared differences
+        # from the mean, for variance
+        self.mean = 0.0
+        self.m2 = 0.0
+
+        # counts of distinct values, for median and unique_counts
+        self.distribution = None
+        self.unique_counts = {}
+        self.top_k_sketch = None
+        if top_k is not None:
+            self.top_k_sketch = SpaceSaving(
+                top_k * custom_functions.TOP_K_CAPACITY_FACTOR)
+        self.quantile_sketch = None
+        if self.quantiles:
+            self.quantile_sketch = TDigest(quantile_compression)
+
+    def update(self, column_df):
+        """
+        folds the column values of a chunk into the running state
+        """
+        if "unique_counts" in self.funcs:
+            if self.top_k_sketch is not None:
+                self.top_k_sketch.update(
+                    custom_functions.get_value_counts(column_df))
+            else:
+                merge_counts(self.unique_counts,
+                             custom_functions.get_unique_counts_of_column(column_df))
+
+        chunk_count = int(column_df.count())
+        if chunk_count == 0:
+            return
+
+        if "sum" in self.funcs or "mean" in self.funcs:
+            self.total += column_df.sum()
+
+        if "min" in self.funcs:
+            self.minimum = np.nanmin([self.minimum, column_df.min()])
+
+        if "max" in self.funcs:
+            self.maximum = np.nanmax([self.maximum, column_df.max()])
+
+        if "any" in self.funcs:
+            self.any = self.any or bool(column_df.any())
+
+        if "variance" in self.funcs:
+            # merge the moments of the chunk into the running moments
+            chunk_mean = float(column_df.mean())
+            chunk_m2 = float(column_df.var(ddof=0)) * chunk_count
+            new_count = self.count + chunk_count
+            delta = chunk_mean - self.mean
+            self.mean += delta * chunk_count / new_count
+            self.m2 += chunk_m2 + delta * delta * self.count * chunk_count / new_count
+
+        if "median" in self.funcs:
+            chunk_distribution = column_df.value_counts()
+            if self.distribution is None:
+                self.distribution = chunk_distribution
+            else:
+                self.distribution = self.distribution.add(
+                    chunk_distribution, fill_value=0)
+
+        if self.quantile_sketch is not None:
+            self.quantile_sketch.add_values(column_df)
+
+        self.count += chunk_count
+
+    def merge(self, other):
+        """
+        merges the running state of other accumulator
+        of the same column into this accumulator
+        """
+        if "unique_counts" in self.funcs:
+            if self.top_k_sketch is not None:
+                self.top_k_sketch.merge(other.top_k_sketch)
+            else:
+                merge_counts(self.unique_counts, other.unique_counts)
+
+        if other.count == 0:
+            return self
+
+        if "sum" in self.funcs or "mean" in self.funcs:
+            self.total += other.total
+
+        if "min" in self.funcs:
+            self.minimum = np.nanmin([self.minimum, other.minimum])
+
+        if "max" in self.funcs:
+            self.maximum = np.nanmax([self.maximum, other.maximum])
+
+        if "any" in self.funcs:
+            self.any = self.any or other.any
+
+        if "variance" in self.funcs:
+            new_count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / new_count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / new_count
+
+        if "median" in self.funcs and other.distribution is not None:
+            if self.distribution is None:
+                self.distribution = other.distribution
+            else:
+                self.distribution = self.distribution.add(
+                    other.distribution, fill_value=0)
+
+        if self.quantile_sketch is not None:
+            self.quantile_sketch.merge(other.quantile_sketch)
+
+        self.count += other.count
+        return self
+
+    def get_states(self) -> set:
+        """
+        returns the partial states kept for the functions of the column
+        """
+        return {
+            state for function in self.funcs
+            for state in (
+                QUANTILE_STATES if function in self.quantiles
+                else BASE_AGGREGATE_STATES.get(function, []))
+        }
+
+    def get_partial(self) -> dict:
+        """
+        returns the partial state of the column,
+        as in BASE_AGGREGATE_STATES
+        """
+        states = self.get_states()
+        partial = {"count": self.count}
+        if "sum" in states:
+            partial["sum"] = self.total
+        if "min" in states:
+            partial["min"] = self.minimum
+        if "max" in states:
+            partial["max"] = self.maximum
+        if "any" in states:
+            partial["any"] = self.any
+        if "moments" in states:
+            partial["mean"] = self.mean
+            partial["m2"] = self.m2
+        if "distribution" in states and self.distribution is not None:
+            partial["distribution"] = get_counts_state(self.distribution)
+        if "unique_counts" in states:
+            if self.top_k_sketch is not None:
+                partial["top_k_sketch"] = self.top_k_sketch.serialize()
+            else:
+                partial["unique_counts"] = get_counts_state(self.unique_counts)
+        if "quantiles" in states:
+            partial["quantile_sketch"] = self.quantile_sketch.serialize()
+        return partial
+
+    def set_partial(self, partial):
+        """
+        sets the running state from the get_partial output
+        """
+        self.count = partial.get("count", 0)
+        self.total = partial.get("sum", 0)
+        self.minimum = partial.get("min", math.nan)
+        self.maximum = partial.get("max", math.nan)
+        self.any = partial.get("any", False)
+        self.mean = partial.get("mean", 0.0)
+        self.m2 = partial.get("m2", 0.0)
+        if "distribution" in partial:
+            self.distribution = pd.Series(
+                partial["distribution"]["counts"],
+                index=partial["distribution"]["values"])
+        if "top_k_sketch" in partial and self.top_k_sketch is not None:
+            self.top_k_sketch = SpaceSaving.deserialize(partial["top_k_sketch"])
+        if "unique_counts" in partial:
+            self.unique_counts = dict(zip(
+                partial["unique_counts"]["values"],
+                partial["unique_counts"]["counts"]))
+        if "quantile_sketch" in partial and self.quantile_sketch is not None:
+            self.quantile_sketch = TDigest.deserialize(partial["quantile_sketch"])
+        return self
+
+    def get_median(self) -> float:
+        """
+        exact median from the counts of distinct values
+        """
+        if self.distribution is None or self.count == 0:
+            return math.nan
+
+        distribution = self.distribution.sort_index()
+        values = distribution.index.to_numpy()
+        cumulative_counts = distribution.to_numpy().cumsum()
+
+        # values at the middle position(s) of the sorted column
+        lower = values[np.searchsorted(
+            cumulative_counts, (self.count - 1) // 2, side="right")]
+        upper = values[np.searchsorted(
+            cumulative_counts, self.count // 2, side="right")]
+        return (lower + upper) / 2
+
+    def finalize(self) -> dict:
+        """
+        returns the basic aggregates of the column
+        in the same form as cal_base_aggregates
+        """
+        result = {}
+        for function in self.funcs:
+            if function == "unique_counts":
+                result[self.column] = self.unique_counts
+                if self.top_k_sketch is not None:
+                    top = self.top_k_sketch.top_k(self.top_k)
+                    result[self.column] = top
+                    result[custom_functions.get_top_k_others_key(self.column)] = max(
+                        self.top_k_sketch.total - sum(top.values()), 0)
+                continue
+
+            out = 0
+            if function == "sum":
+                out = self.total
+            if function == "min":
+                out = self.minimum
+            if function == "max":
+                out = self.maximum
+            if function == "mean":
+                out = self.total / self.count if self.count else math.nan
+            if function == "median":
+                out = self.get_median()
+            if function == "variance":
+                out = self.m2 / (self.count - 1) if self.count > 1 else math.nan
+            if function in self.quantiles:
+                out = self.quantile_sketch.quantile(
+                    custom_functions.get_quantile(function))
+            if function == "any":
+                out = self.any
+            if function == "count":
+                out = self.count
+            result[str(self.column) + "_" + str(function)] = float(out)
+        return result
+
+
+class IntervalAccumulator:
+    """
+    running state of all the provisioned aggregates of a single interval,
+    updated with every chunk of the input data that falls in the interval
+    """
+
+    def __init__(self, provision_metadata):
+        self.provision_metadata = provision_metadata
+
+        self.columns = {
+            col: ColumnAccumulator(
+                col, function_list["funcs"], provision_metadata.top_k.get(col),
+                provision_metadata.quantile_compression)
+            for col, function_list in provision_metadata.fields_to_aggregate.items()
+            if function_list["funcs"]
+        }
+
+        # partial results of each custom function
+        self.custom_results = {
+            function: {} for function in provision_metadata.custom_functions
+        }
+        self.unique_visitors = set()
+        self.unique_visitor_keys = custom_functions.merge_unique_visitor_keys()
+        self.unique_visitor_sketch = None
+        if provision_metadata.unique_visitor_mode == "hll":
+            self.unique_visitor_sketch = HyperLogLog(
+                provision_metadata.unique_visitor_precision)
+
+    def update(self, df_ctxt):
+        """
+        folds a chunk of the interval into the running state
+        """
+        for col, column_accumulator in self.columns.items():
+            column_accumulator.update(df_ctxt[col])
+
+        ctxt = IntervalContext(df_ctxt)
+        for function, partial in self.custom_results.items():
+            if function == "get_total_hits":
+                merge_counts(partial, {"total_hits": len(df_ctxt.index)})
+
+            if function == "get_status_code_level_hit_counts":
+                merge_counts(partial, {"total_hits": len(df_ctxt.index)})
+                merge_counts(partial, custom_functions.get_status_code_levels_from_counts(
+                    ctxt.get("value_counts", "statuscode")))
+
+            if function == "get_cachestatus":
+                merge_counts(partial, custom_functions.cal_cache_status_from_counts(
+                    ctxt.get("value_counts", "cachestatus")))
+
+            if function == "get_traffic_volume":
+                merge_counts(partial, {
+                    "traffic_volume": custom_functions.get_traffic_volume_from_sum(
+                        ctxt.get("sum", "totalbytes"))
+                })
+
+            if function == "get_offload_rate":
+                cache_hits, _, total_hits = custom_functions.count_cache_status_from_counts(
+                    ctxt.get("value_counts", "cachestatus"))
+                merge_counts(partial, {
+                    "cache_hits": cache_hits,
+                    "cache_total": total_hits,
+                })
+
+            if function == "get_origin_response_time":
+                merge_counts(partial, {
+                    "origin_response_time": custom_functions.cal_origin_responsetime_from_masks(
+                        ctxt.get("mask", "cachestatus", 0),
+                        ctxt.get("mask", "cacherefreshsrc", "origin"),
+                        ctxt.get("column", "turnaroundtimemsec"),
+                    )
+                })
+
+            if function == "get_user_agent_details":
+                merge_counts(partial, custom_functions.parse_user_agent_from_counts(
+                    ctxt.get("value_counts", "ua")))
+
+            if function == "get_unique_visitor":
+                if self.unique_visitor_sketch is not None:
+                    self.unique_visitor_sketch.add_hashes(pd.util.hash_pandas_object(
+                        df_ctxt[["ua", "cliip"]], index=False).to_numpy())
+                elif self.provision_metadata.unique_visitor_mode == "hashed":
+                    self.unique_visitor_keys = custom_functions.merge_unique_visitor_keys(
+                        self.unique_visitor_keys,
+                        custom_functions.hash_unique_visitors(
+                            df_ctxt[["ua", "cliip"]])
+                    )
+                else:
+                    self.unique_visitors.update(
+                        custom_functions.calc_unique_visitor(
+                            df_ctxt[["ua", "cliip"]])["unique_visitors_value"]
+                    )
+        ctxt.clear()
+
+    def merge(self, other):
+        """
+        merges the running state of other accumulator
+        of the same interval into this accumulator
+        """
+        for col, column_accumulator in self.columns.items():
+            column_accumulator.merge(other.columns[col])
+
+        for function, partial in self.custom_results.items():
+            merge_counts(partial, other.custom_results[function])
+
+        self.unique_visitors.update(other.unique_visitors)
+        self.unique_visitor_keys = custom_functions.merge_unique_visitor_keys(
+            self.unique_visitor_keys, other.unique_visitor_keys)
+        if self.unique_visitor_sketch is not None:
+            self.unique_visitor_sketch.merge(other.unique_visitor_sketch)
+        return self
+
+    def get_partial(self) -> dict:
+        """
+        returns the partial state of the interval,
+        the partial states of the columns as in BASE_AGGREGATE_STATES,
+        the counts and sums of the custom functions, and the unique
+        visitors as in unique-visitor-mode
+        """
+        partial = {
+            "columns": {
+                col: column_accumulator.get_partial()
+                for col, column_accumulator in self.columns.items()
+            },
+            "custom_functions": self.custom_results,
+        }
+        if "get_unique_visitor" in self.custom_results:
+            if self.unique_visitor_sketch is not None:
+                partial["unique_visitors_sketch"] = (
+                    self.unique_visitor_sketch.serialize())
+            elif self.provision_metadata.unique_visitor_mode == "hashed":
+                partial["unique_visitors_keys"] = (
+                    custom_functions.encode_unique_visitor_keys(
+                        self.unique_visitor_keys))
+            else:
+                partial["unique_visitors"] = list(self.unique_visitors)
+        return partial
+
+    def set_partial(self, partial):
+        """
+        sets the running state from the get_partial output,
+        the states of the columns and functions that are not
+        provisioned are ignored
+        """
+        for col, column_partial in partial.get("columns", {}).items():
+            if col in self.columns:
+                self.columns[col].set_partial(column_partial)
+
+        for function, custom_partial in partial.get("custom_functions", {}).items():
+            if function in self.custom_results:
+                self.custom_results[function] = custom_partial
+
+        if "unique_visitors_sketch" in partial and self.unique_visitor_sketch is not None:
+            self.unique_visitor_sketch = HyperLogLog.deserialize(
+                partial["unique_visitors_sketch"])
+        if "unique_visitors_keys" in partial:
+            self.unique_visitor_keys = custom_functions.decode_unique_visitor_keys(
+                partial["unique_visitors_keys"]).copy()
+        if "unique_visitors" in partial:
+            self.unique_visitors = set(map(tuple, partial["unique_visitors"]))
+        return self
+
+    def serialize(self) -> str:
+        """
+        returns the partial state as base64 string
+        """
+        payload = json.dumps(self.get_partial(), default=get_json_value)
+        return base64.b64encode(zlib.compress(payload.encode("utf-8"))).decode("ascii")
+
+    @classmethod
+    def deserialize(cls, serialized, provision_metadata):
+        """
+        returns the accumulator from the serialize output,
+        for the same provision_metadata
+        """
+        partial = json.loads(zlib.decompress(base64.b64decode(serialized)))
+        return cls(provision_metadata).set_partial(partial)
+
+    def finalize(self) -> dict:
+        """
+        returns the aggregated result of the interval
+        in the same form as Aggregator.process_data_per_ctxt
+        """
+        result = {}
+        for column_accumulator in self.columns.values():
+            result.update(column_accumulator.finalize())
+
+        for function, partial in self.custom_results.items():
+            if function == "get_offload_rate":
+                result["offload_rate"] = custom_functions.get_offload_rate(
+                    partial.get("cache_hits", 0), partial.get("cache_total", 0))
+            elif function == "get_unique_visitor":
+                if self.unique_visitor_sketch is not None:
+                    result["unique_visitors"] = self.unique_visitor_sketch.count()
+                    result["unique_visitors_sketch"] = (
+                        self.unique_visitor_sketch.serialize())
+                elif self.provision_metadata.unique_visitor_mode == "hashed":
+                    result["unique_visitors"] = len(self.unique_visitor_keys)
+                    result["unique_visitors_keys"] = (
+                        custom_functions.encode_unique_visitor_keys(
+                            self.unique_visitor_keys)
+                    )
+                else:
+                    result["unique_visitors_value"] = list(self.unique_visitors)
+            else:
+                result.update(partial)
+        return result
+
+
+def merge_results(results, provision_metadata) -> list:
+    """
+    merges the results of the same interval, say of different files,
+    by their "partial_state", and returns a result per interval in time
+    order along with the merged "partial_state"
+    the results are of the same provision_metadata, and the results
+    without "partial_state" are logged and skipped
+    """
+    accumulators = {}
+    for result in results:
+        if "partial_state" not in result:
+            logger.warning("no partial_state in the result of interval: %s",
+                           result.get("start_timestamp"))
+            continue
+
+        agg_timestamp = result.get("start_timestamp")
+        accumulator = IntervalAccumulator.deserialize(
+            result["partial_state"], provision_metadata)
+        if agg_timestamp in accumulators:
+            accumulators[agg_timestamp].merge(accumulator)
+        else:
+            accumulators[agg_timestamp] = accumulator
+
+    merged_results = []
+    for agg_timestamp, accumulator in sorted(
+            accumulators.items(), key=lambda item: item[0] or 0):
+        result = {}
+        if agg_timestamp is not None:
+            result["start_timestamp"] = agg_timestamp
+        result.update(accumulator.finalize())
+        result["partial_state"] = accumulator.serialize()
+        merged_results.append(result)
+    return merged_results
@@ -0,0 +1,425 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+compiles the provisioned aggregations into a plan of resolved
+functions and their input columns, built once per provision file
+"""
+
+import functools
+import json
+import logging
+
+from aggregation_modules import custom_functions
+from aggregation_modules.interval_context import IntervalContext
+
+logger = logging.getLogger(__name__)
+
+
+# steps for each custom function in all_custom_functions.json
+# as (output key or keys, function, input columns, input intermediates)
+# function is called with the input intermediates of the interval,
+# or with the input columns when no intermediates are given, and
+# returns the value of the output key, or a dict of the output keys
+# when a list of keys is given
+CUSTOM_FUNCTION_STEPS = {
+    "get_total_hits": [
+        ("total_hits", custom_functions.get_total_hits, [], None),
+    ],
+    "get_traffic_volume": [
+        (
+            "traffic_volume",
+            custom_functions.get_traffic_volume_from_sum,
+            ["totalbytes"],
+            [("sum", "totalbytes")],
+        ),
+    ],
+    "get_status_code_level_hit_counts": [
+        ("total_hits", custom_functions.get_total_hits, [], None),
+        (
+            list(custom_functions.get_status_code_fillers()),
+            custom_functions.get_status_code_levels_from_counts,
+            ["statuscode"],
+            [("value_counts", "statuscode")],
+        ),
+    ],
+    "get_cachestatus": [
+        (
+            ["cache_hit", "cache_miss"],
+            custom_functions.cal_cache_status_from_counts,
+            ["cachestatus"],
+            [("value_counts", "cachestatus")],
+        ),
+    ],
+    "get_offload_rate": [
+        (
+            "offload_rate",
+            custom_functions.cal_offload_rate_from_counts,
+            ["cachestatus"],
+            [("value_counts", "cachestatus")],
+        ),
+    ],
+    "get_origin_response_time": [
+        (
+            "origin_response_time",
+            custom_functions.cal_origin_responsetime_from_masks,
+            ["cachestatus", "cacherefreshsrc", "turnaroundtimemsec"],
+            [
+                ("mask", "cachestatus", 0),
+                ("mask", "cacherefreshsrc", "origin"),
+                ("column", "turnaroundtimemsec"),
+            ],
+        ),
+    ],
+    "get_user_agent_details": [
+        (
+            ["os", "browser", "platform"],
+            custom_functions.parse_user_agent_from_counts,
+            ["ua"],
+            [("value_counts", "ua")],
+        ),
+    ],
+    "get_unique_visitor": [
+        (
+            ["unique_visitors_value"],
+            custom_functions.calc_unique_visitor,
+            ["ua", "cliip"],
+            None,
+        ),
+    ],
+}
+
+# steps for get_unique_visitor for each unique-visitor-mode
+UNIQUE_VISITOR_STEPS = {
+    "list": CUSTOM_FUNCTION_STEPS["get_unique_visitor"],
+    "hashed": [
+        (
+            ["unique_visitors", "unique_visitors_keys"],
+            custom_functions.calc_unique_visitor_hashed,
+            ["ua", "cliip"],
+            None,
+        ),
+    ],
+    "hll": [
+        (
+            ["unique_visitors", "unique_visitors_sketch"],
+            custom_functions.calc_unique_visitor_sketch,
+            ["ua", "cliip"],
+            None,
+        ),
+    ],
+}
+
+
+# basic aggregates that are shared as intermediates of the same name
+SHARED_BASE_AGGREGATES = ["sum"]
+
+
+class AggregationStep:
+    """
+    a unit of work of the plan, calls the resolved function
+    with the input columns or intermediates of an interval
+    """
+
+    def __init__(self, name, function, columns, output_keys,
+                 single_output=False, inputs=None):
+        self.name = name
+        self.function = function
+        self.columns = columns
+        self.output_keys = output_keys
+        # function returns the value of the only output key
+        self.single_output = single_output
+        # keys of the IntervalContext intermediates passed to function
+        self.inputs = inputs
+
+    def get_input(self, df_ctxt):
+        """
+        returns the input columns of the step from the interval dataframe
+        """
+        if not self.columns:
+            return df_ctxt
+        if len(self.columns) == 1:
+            return df_ctxt[self.columns[0]]
+        return df_ctxt[self.columns]
+
+    def run(self, ctxt) -> dict:
+        """
+        returns the outputs of the step for the interval context
+        """
+        if self.inputs is not None:
+            out = self.function(*[ctxt.get(*key) for key in self.inputs])
+        else:
+            out = self.function(self.get_input(ctxt.dataframe))
+        if self.single_output:
+            return {self.output_keys[0]: out}
+        return out
+
+    def describe(self) -> dict:
+        """
+        returns the details of the step
+        """
+        # unwrap functions with provisioned arguments
+        function = getattr(self.function, "func", self.function)
+        return {
+            "step": self.name,
+            "function": f"{function.__module__}.{function.__name__}",
+            "columns": self.columns,
+            "inputs": self.inputs,
+            "outputs": self.output_keys,
+        }
+
+
+class BaseAggregatesStep(AggregationStep):
+    """
+    all the basic aggregates of a single column,
+    calculated together in one Series.agg call
+    """
+
+    def __init__(self, column, functions):
+        super().__init__(
+            column,
+            custom_functions.cal_fused_base_aggregates,
+            [column],
+            [str(column) + "_" + str(function) for function in functions],
+        )
+        self.functions = functions
+
+    def get_outputs(self, aggregates) -> dict:
+        """
+        maps the function -> value dict to the output keys
+        """
+        return {
+            key_name: aggregates[function]
+            for key_name, function in zip(self.output_keys, self.functions)
+        }
+
+    def run(self, ctxt) -> dict:
+        return self.get_outputs(
+            self.function(self.functions, ctxt.get("column", self.columns[0])))
+
+    def share(self, ctxt, outputs):
+        """
+        adds the aggregates that are also intermediates, say sum,
+        to the interval context
+        """
+        for key_name, function in zip(self.output_keys, self.functions):
+            if function in SHARED_BASE_AGGREGATES:
+                ctxt.set(outputs[key_name], function, self.columns[0])
+
+    def run_grouped(self, grouped) -> dict:
+        """
+        returns the outputs of the step for all the groups at once
+        """
+        aggregates = custom_functions.cal_grouped_base_aggregates(
+            self.functions, grouped[self.columns[0]])
+        return {
+            group: self.get_outputs(group_aggregates)
+            for group, group_aggregates in aggregates.items()
+        }
+
+    def describe(self) -> dict:
+        details = super().describe()
+        details["functions"] = self.functions
+        return details
+
+
+class QuantilesStep(AggregationStep):
+    """
+    all the quantile functions of a single column, say p50 and p99,
+    estimated together from one t-digest sketch of the column
+    """
+
+    def __init__(self, column, functions, compression=100):
+        super().__init__(
+            column,
+            functools.partial(
+                custom_functions.cal_quantiles, compression=compression),
+            [column],
+            [str(column) + "_" + str(function) for function in functions],
+        )
+        self.functions = functions
+
+    def run(self, ctxt) -> dict:
+        quantiles = self.function(
+            self.functions, ctxt.get("column", self.columns[0]))
+        return {
+            key_name: quantiles[function]
+            for key_name, function in zip(self.output_keys, self.functions)
+        }
+
+    def describe(self) -> dict:
+        details = super().describe()
+        details["functions"] = self.functions
+        return details
+
+
+class AggregationPlan:
+    """
+    ordered list of steps that produce the result of
+    an interval for the provisioned aggregations
+    """
+
+    def __init__(self, provision_metadata=None):
+        self.steps = []
+        if provision_metadata is not None:
+            self.compile(provision_metadata)
+
+    def __str__(self) -> str:
+        return json.dumps(self.describe(), indent=2)
+
+    def compile(self, provision_metadata):
+        """
+        resolves the fields_to_aggregate and custom_functions
+        of provision_metadata into steps
+        """
+        self.steps = []
+
+        for col, function_list in provision_metadata.fields_to_aggregate.items():
+            functions = [
+                function for function in function_list["funcs"]
+                if function not in ["unique_counts"]
+                and custom_functions.get_quantile(function) is None
+            ]
+            if functions:
+                self.steps.append(BaseAggregatesStep(col, functions))
+
+            quantiles = [
+                function for function in function_list["funcs"]
+                if custom_functions.get_quantile(function) is not None
+            ]
+            if quantiles:
+                self.steps.append(QuantilesStep(
+                    col, quantiles, provision_metadata.quantile_compression))
+
+            if "unique_counts" in function_list["funcs"] and col in provision_metadata.top_k:
+                self.steps.append(AggregationStep(
+                    col,
+                    functools.partial(
+                        custom_functions.get_top_k_from_counts,
+                        column=col, k=provision_metadata.top_k[col]),
+                    [col],
+                    [col, custom_functions.get_top_k_others_key(col)],
+                    inputs=[("value_counts", col)],
+                ))
+            elif "unique_counts" in function_list["funcs"]:
+                self.steps.append(AggregationStep(
+                    col,
+                    custom_functions.get_unique_counts_from_counts,
+                    [col],
+                    [col],
+                    single_output=True,
+                    inputs=[("value_counts", col)],
+                ))
+
+        enabled_functions = [
+            function for function in provision_metadata.custom_functions
+            if function in CUSTOM_FUNCTION_STEPS
+        ]
+        for function in provision_metadata.custom_functions:
+            if function not in CUSTOM_FUNCTION_STEPS:
+                logger.warning(
+                    "no implementation found for custom function: %s", function)
+
+        for function in enabled_functions:
+            step_name = function
+            function_steps = CUSTOM_FUNCTION_STEPS[function]
+            if function == "get_unique_visitor":
+                function_steps = UNIQUE_VISITOR_STEPS[
+                    provision_metadata.unique_visitor_mode]
+
+            for output_keys, step_function, columns, inputs in function_steps:
+                if self.has_step(step_function, columns):
+                    # same outputs are already calculated, say total_hits
+                    continue
+
+                if step_function is custom_functions.calc_unique_visitor_sketch:
+                    step_function = functools.partial(
+                        step_function,
+                        precision=provision_metadata.unique_visitor_precision)
+
+                single_output = isinstance(output_keys, str)
+                self.steps.append(AggregationStep(
+                    step_name,
+                    step_function,
+                    columns,
+                    [output_keys] if single_output else output_keys,
+                    single_output=single_output,
+                    inputs=inputs,
+                ))
+
+        logger.debug("aggregation plan... \n%s", self)
+
+    def has_step(self, function, columns) -> bool:
+        """
+        checks if the plan already calls function with the columns
+        """
+        return any(
+            step.function is function and step.columns == columns
+            for step in self.steps
+        )
+
+    def run_steps(self, ctxt, base_outputs=None) -> dict:
+        """
+        returns the result of the interval context, base_outputs
+        has the already calculated outputs of the base aggregate steps
+        """
+        result = {}
+        for step in self.steps:
+            if isinstance(step, BaseAggregatesStep):
+                outputs = (base_outputs[step] if base_outputs is not None
+                           else step.run(ctxt))
+                step.share(ctxt, outputs)
+            else:
+                outputs = step.run(ctxt)
+            result.update(outputs)
+        return result
+
+    def run(self, df_ctxt) -> dict:
+        """
+        returns the result of the interval dataframe
+        """
+        ctxt = IntervalContext(df_ctxt)
+        try:
+            return self.run_steps(ctxt)
+        finally:
+            ctxt.clear()
+
+    def run_grouped(self, grouped) -> dict:
+        """
+        returns dict of group -> result for the grouped dataframe,
+        basic aggregates are calculated for all the groups at once
+        """
+        grouped_outputs = {
+            step: step.run_grouped(grouped)
+            for step in self.steps
+            if isinstance(step, BaseAggregatesStep)
+        }
+
+        results = {}
+        for group, df_ctxt in grouped:
+            ctxt = IntervalContext(df_ctxt)
+            try:
+                results[group] = self.run_steps(ctxt, {
+                    step: outputs[group]
+                    for step, outputs in grouped_outputs.items()
+                })
+            finally:
+                ctxt.clear()
+        return results
+
+    def describe(self) -> list:
+        """
+        returns the details of all the steps
+        """
+        return [step.describe() for step in self.steps]
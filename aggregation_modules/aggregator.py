@@ -16,20 +16,39 @@
 Functions to aggregate data
 """
 
+import concurrent.futures
 import importlib
 import json
 import logging
 import os
 import sys
+import threading
 import time
 
 from aggregation_modules import custom_functions
+from aggregation_modules.accumulators import IntervalAccumulator
+from aggregation_modules.aggregation_plan import AggregationPlan
 from aggregation_modules.provision_parser import ProvisionMetadata
+from aggregation_modules.state_store import IntervalStateStore
 from aggregation_modules.stream_parser import StreamMetadata
 from aggregation_modules.utils import BaseUtils
 
 logger = logging.getLogger(__name__)
 
+# time in secs to wait for each metadata file,
+# can be set with METADATA_FETCH_TIMEOUT env variable
+METADATA_FETCH_TIMEOUT = 30
+
+# number of input files read at a time by process_input_files,
+# can be set with INPUT_FILES_CONCURRENCY env variable
+INPUT_FILES_CONCURRENCY = 4
+
+# kept for the invocations of a warm container,
+# cloud -> storage object, with its clients and metadata cache
+CLOUD_STORAGE_OBJECTS = {}
+# (cloud, read_provision) -> parsed metadata and the files they are parsed from
+PARSED_METADATA = {}
+
 
 def import_dynamic_modules(module_name):
     """
@@ -68,18 +87,25 @@ class Aggregator:
         # to hold class objects
         self.provision_metadata = None
         self.stream_metadata = None
+        self.aggregation_plan = None
 
         # input
         self.input_file = None
 
         # to hold the results
         self.dataframe = None
+        self.data_chunks = None
         self.result = {}
         self.result_map = []
 
         # supported other values: azure or aws
         self.cloud = cloud_provider
 
+        self.metadata_fetch_timeout = float(
+            os.environ.get("METADATA_FETCH_TIMEOUT", METADATA_FETCH_TIMEOUT))
+        self.input_files_concurrency = int(
+            os.environ.get("INPUT_FILES_CONCURRENCY", INPUT_FILES_CONCURRENCY))
+
         # init cloud object
         self.cloud_storage_object = None
         self.init_cloud_storage_object()
@@ -90,6 +116,11 @@ class Aggregator:
         cloud service
         """
 
+        if self.cloud in CLOUD_STORAGE_OBJECTS:
+            # warm container, reuse the clients and metadata cache
+            self.cloud_storage_object = CLOUD_STORAGE_OBJECTS[self.cloud]
+            return
+
         if self.cloud is None:
             self.cloud_storage_object = BaseUtils()
 
@@ -103,93 +134,235 @@ class Aggregator:
             self.aws = import_dynamic_modules("cloud_modules_aws.utils")
             self.cloud_storage_object = self.aws.AWSStorageContainer()
 
+        if self.cloud_storage_object is not None:
+            CLOUD_STORAGE_OBJECTS[self.cloud] = self.cloud_storage_object
+
     def read_metadata(self, read_provision=True):
         """
-        Parent function to read all metadata/config files
+        Parent function to read all metadata/config files,
+        the files are fetched concurrently
         """
-        self.read_all_datastream2_fields()
-        self.read_all_custom_functions()
-        self.read_stream_metadata()
-        if read_provision:
-            self.read_provision()
+        metadata = self.fetch_metadata(read_provision)
+        if self.reuse_parsed_metadata(metadata, read_provision):
+            return
 
-    def read_all_datastream2_fields(self):
+        self.read_all_datastream2_fields(metadata["all_datastream2_fields"])
+        self.read_all_custom_functions(metadata["all_custom_functions"])
+        self.read_stream_metadata(metadata["stream_file"])
+        if read_provision:
+            self.read_provision(metadata["provision_file"])
+
+        PARSED_METADATA[(self.cloud, read_provision)] = {
+            "files": metadata,
+            "all_fields_map": self.all_fields_map,
+            "all_custom_functions": self.all_custom_functions,
+            "stream_metadata": self.stream_metadata,
+            "provision_metadata": self.provision_metadata,
+            "aggregation_plan": self.aggregation_plan,
+        }
+
+    def reuse_parsed_metadata(self, metadata, read_provision=True) -> bool:
+        """
+        sets the metadata parsed by an earlier invocation of the
+        warm container when none of the files are modified since,
+        the metadata cache returns the same objects for those files
+        """
+        parsed = PARSED_METADATA.get((self.cloud, read_provision))
+        if parsed is None or parsed["files"].keys() != metadata.keys():
+            return False
+        if any(parsed["files"][key] is not content
+               for key, content in metadata.items()):
+            return False
+
+        logger.debug("metadata files not modified, reusing parsed metadata")
+        self.all_fields_map = parsed["all_fields_map"]
+        self.all_custom_functions = parsed["all_custom_functions"]
+        self.stream_metadata = parsed["stream_metadata"]
+        self.provision_metadata = parsed["provision_metadata"]
+        self.aggregation_plan = parsed["aggregation_plan"]
+        return True
+
+    def fetch_metadata(self, read_provision=True) -> dict:
+        """
+        fetches the metadata/config files on a thread pool and returns
+        dict of input_configs key -> file content, so that it takes the
+        time of the slowest fetch instead of the sum of all the fetches.
+        each file is given metadata_fetch_timeout secs from the start
+        of its fetch, and the files that fail or time out are logged
+        and the error is raised, as the run can't go on without them
+        """
+        readers = {
+            "all_datastream2_fields":
+                self.cloud_storage_object.read_all_datastream2_fields_metadata,
+            "all_custom_functions":
+                self.cloud_storage_object.read_all_custom_functions_metadata,
+            "stream_file": self.cloud_storage_object.read_stream_metadata,
+        }
+        if read_provision:
+            readers["provision_file"] = self.cloud_storage_object.read_provision_metadata
+
+        # start time of each fetch, set by the thread that runs it
+        started = {}
+
+        def fetch(key, reader):
+            started[key] = time.monotonic()
+            return reader()
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(readers))
+        futures = {
+            key: executor.submit(fetch, key, reader)
+            for key, reader in readers.items()
+        }
+
+        metadata = {}
+        errors = {}
+        for key, future in futures.items():
+            file_name = self.cloud_storage_object.input_configs[key]
+            try:
+                timeout = self.metadata_fetch_timeout
+                if key in started:
+                    timeout = max(
+                        started[key] + timeout - time.monotonic(), 0)
+                metadata[key] = future.result(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                logger.error("timed out fetching %s after %s secs",
+                             file_name, self.metadata_fetch_timeout)
+                errors[file_name] = TimeoutError(
+                    f"timed out fetching {file_name} after "
+                    f"{self.metadata_fetch_timeout} secs")
+            except Exception as err:
+                logger.error("fetching %s: %s: %s", file_name, type(err), err)
+                errors[file_name] = err
+
+        # do not wait for the fetches that timed out
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        if len(errors) == 1:
+            raise next(iter(errors.values()))
+        if errors:
+            raise RuntimeError(
+                f"failed to fetch metadata files: {', '.join(errors)}"
+            ) from next(iter(errors.values()))
+        return metadata
+
+    def read_all_datastream2_fields(self, all_fields_map=None):
         """
         reads the all_datastream2_fields.json file consisting of
         all field related details say, id, field name, functions etc
+        or uses the content already fetched
         """
-        self.all_fields_map = self.cloud_storage_object.read_all_datastream2_fields_metadata()
+        if all_fields_map is None:
+            all_fields_map = self.cloud_storage_object.read_all_datastream2_fields_metadata()
+        self.all_fields_map = all_fields_map
         for i in self.all_fields_map:
             self.all_fields_map[i]["name"] = self.all_fields_map[i]["name"].lower(
             )
 
-    def read_all_custom_functions(self):
+    def read_all_custom_functions(self, all_custom_functions=None):
         """
         reads all_custom_functions.json file and parse
         the functions details
         """
-        self.all_custom_functions = (
-            self.cloud_storage_object.read_all_custom_functions_metadata()
-        )
+        if all_custom_functions is None:
+            all_custom_functions = (
+                self.cloud_storage_object.read_all_custom_functions_metadata()
+            )
+        self.all_custom_functions = all_custom_functions
         logger.debug("self.all_custom_functions: %s",
                      self.all_custom_functions)
 
-    def read_stream_metadata(self):
+    def read_stream_metadata(self, stream_buffer=None):
         """
         reads <stream>.json file and parse
         stream related details
         """
         self.stream_metadata = StreamMetadata()
-        stream_buffer = self.cloud_storage_object.read_stream_metadata()
+        if stream_buffer is None:
+            stream_buffer = self.cloud_storage_object.read_stream_metadata()
         self.stream_metadata.populate_fields(
             stream_buffer, self.all_fields_map)
 
-    def read_provision(self):
+    def read_provision(self, prov_buffer=None):
         """
         To read the provision file containing
         the list of functions to aggregate data
         """
         self.provision_metadata = ProvisionMetadata()
-        prov_buffer = (
-            self.cloud_storage_object.read_provision_metadata()
-        )
+        if prov_buffer is None:
+            prov_buffer = (
+                self.cloud_storage_object.read_provision_metadata()
+            )
         self.provision_metadata.populate_fields(
             prov_buffer, self.all_custom_functions)
+        self.aggregation_plan = AggregationPlan(self.provision_metadata)
 
     def read_input_data(self, input_file, bucket_name=None):
         """
-        read the input file and sets the dataframe
+        read the input file and sets the dataframe,
+        or the iterator of dataframe chunks when chunk-size is provisioned
         """
 
         self.input_file = input_file
+        input_data = self.read_input_file(input_file, bucket_name)
+
+        if self.provision_metadata.chunk_size > 0:
+            self.data_chunks = input_data
+        else:
+            self.dataframe = input_data
+
+    def read_input_file(self, input_file, bucket_name=None):
+        """
+        reads the input file and returns the dataframe,
+        or the iterator of dataframe chunks when chunk-size is provisioned
+        """
+        chunksize = None
+        if self.provision_metadata.chunk_size > 0:
+            chunksize = self.provision_metadata.chunk_size
+
+        # fields are typed by the parser as in stream metadata
+        parse_dtypes = self.stream_metadata.get_parse_dtypes(
+            self.provision_metadata.get_provision_field_names())
+
+        input_data = None
         # from local dir
         if self.cloud is None:
-            self.dataframe = self.cloud_storage_object.read_data_file_from_local(
-                self.input_file,
+            input_data = self.cloud_storage_object.read_data_file_from_local(
+                input_file,
                 self.stream_metadata.stream_format,
                 self.stream_metadata.get_stream_field_names(),
                 self.provision_metadata.get_provision_field_names(),
+                chunksize=chunksize,
+                parse_dtypes=parse_dtypes,
+                parse_engine=self.provision_metadata.parse_engine,
             )
 
         # for azure
         if self.cloud == "azure":
-            self.dataframe = self.cloud_storage_object.read_data_file_from_azure_blob(
-                self.input_file,
+            input_data = self.cloud_storage_object.read_data_file_from_azure_blob(
+                input_file,
                 self.stream_metadata.stream_format,
                 self.stream_metadata.get_stream_field_names(),
                 self.provision_metadata.get_provision_field_names(),
+                chunksize=chunksize,
+                parse_dtypes=parse_dtypes,
+                parse_engine=self.provision_metadata.parse_engine,
             )
 
         # for aws
         if self.cloud == "aws":
-            self.dataframe = self.cloud_storage_object.read_data_file_from_s3(
+            input_data = self.cloud_storage_object.read_data_file_from_s3(
                 bucket_name,
-                self.input_file,
+                input_file,
                 self.stream_metadata.stream_format,
                 self.stream_metadata.get_stream_field_names(),
                 self.provision_metadata.get_provision_field_names(),
+                chunksize=chunksize,
+                parse_dtypes=parse_dtypes,
+                parse_engine=self.provision_metadata.parse_engine,
             )
 
+        return input_data
+
     def get_custom_functions(self):
         """
         Gets all custom fields available to the user
@@ -219,108 +392,54 @@ class Aggregator:
         reads dataframe and aggregate data
         """
 
-        logger.debug(self.provision_metadata.fields_to_aggregate)
-        # invoke selected aggregation functions for fields
-        for col, function_list in self.provision_metadata.fields_to_aggregate.items():
-            for function in function_list["funcs"]:
-                if function in ["unique_counts"]:
-                    self.result.update(
-                        custom_functions.parse_unique_count_for_column(
-                            df_ctxt[col], col)
-                    )
-                else:
-                    key_name = str(col) + "_" + str(function)
-                    self.result[key_name] = custom_functions.cal_base_aggregates(
-                        function,
-                        df_ctxt[col]
-                    )
-
-        # invoke selected custom aggregate functions
-        for function in self.provision_metadata.custom_functions:
-            if function == "get_status_code_level_hit_counts":
-                self.result["total_hits"] = len(df_ctxt.index)
-
-            if function == "get_status_code_level_hit_counts":
-                self.result.update(
-                    custom_functions.get_status_code_level_hit_counts(
-                        df_ctxt["statuscode"])
-                )
-
-            if function == "get_cachestatus":
-                self.result.update(
-                    custom_functions.cal_cache_status(df_ctxt["cachestatus"])
-                )
-
-            if function == "get_traffic_volume":
-                self.result["traffic_volume"] = custom_functions.get_traffic_volume(
-                    df_ctxt["totalbytes"]
-                )
-
-            if function == "get_offload_rate":
-                self.result["offload_rate"] = custom_functions.cal_offload_rate(
-                    df_ctxt["cachestatus"]
-                )
-
-            if function == "get_origin_response_time":
-                self.result[
-                    "origin_response_time"
-                ] = custom_functions.cal_origin_responsetime(
-                    df_ctxt[
-                        ["cachestatus", "cacherefreshsrc", "turnaroundtimemsec"]
-                    ]
-                )
-
-            if function == "get_user_agent_details":
-                self.result.update(
-                    custom_functions.parse_user_agent(df_ctxt["ua"])
-                )
-
-            if function == "get_unique_visitor":
-                self.result.update(custom_functions.calc_unique_visitor(df_ctxt[
-                        ["ua", "cliip"]
-                    ]))
-        # all new custom defined functions can be invoked here
+        # invoke the selected aggregate and custom functions
+        # as resolved in the aggregation plan
+        self.result.update(self.aggregation_plan.run(df_ctxt))
+        # all new custom defined functions can be added to
+        # aggregation_plan.CUSTOM_FUNCTION_STEPS
         return self.result
 
-    def preprocess_dataframe(self):
+    def set_aggregated_time(self, dataframe=None):
         """
-        pre process the dataframe constructed from the input data
-        for integer columns sets non integer values to 0
-        for non integer columns sets "-" to "others"
+        adds aggregated_time column to the dataframe, or to self.dataframe,
+        containing the start time of the interval each row belongs to
         """
-        for column_name in self.provision_metadata.get_provision_field_names():
-            # integer fields
-            if self.stream_metadata.get_data_type_for_field(column_name) == "bigint":
-                self.dataframe[column_name] = custom_functions.convert_to_numeric(
-                    self.dataframe[column_name])
-
-            # string fields
-            if self.stream_metadata.get_data_type_for_field(column_name) == "string":
-                self.dataframe[column_name] = custom_functions.replace_string(
-                    self.dataframe[column_name], "-", "others")
+        if dataframe is None:
+            dataframe = self.dataframe
+        dataframe["aggregated_time"] = custom_functions.convert_time_to_interval(
+            dataframe[self.aggregate_column],
+            delta=self.provision_metadata.aggregation_interval)
 
     def process_data(self) -> dict:
         """
         reads dataframe and aggregate data
         """
 
-        self.preprocess_dataframe()
+        if self.data_chunks is not None:
+            return self.process_data_in_chunks()
+
+        if (self.provision_metadata.partial_state
+                or self.provision_metadata.state_store_dir is not None):
+            # the partial states are kept by the accumulators
+            self.data_chunks = [self.dataframe]
+            return self.process_data_in_chunks()
+
         if self.provision_metadata.aggregation_interval > 0:
-            self.dataframe["aggregated_time"] = self.dataframe.apply(
-                lambda x: custom_functions.convert_time(
-                    x[self.aggregate_column],
-                    delta=self.provision_metadata.aggregation_interval), axis=1)
+            self.set_aggregated_time()
             logger.debug(
                 "top 5 rows with aggregated time interval[aggregated_time]... \n%s",
                 self.dataframe.head(5))
             logger.debug("unique time intervals in the dataset: %s",
                          self.dataframe["aggregated_time"].unique())
 
-            # for each agg interval process the data
-            for agg_timestamp in self.dataframe["aggregated_time"].unique():
+            # group the rows by interval in a single pass, the basic
+            # aggregates are calculated for all intervals at once and
+            # custom functions once for each interval
+            grouped = self.dataframe.groupby("aggregated_time", sort=False)
+            interval_results = self.aggregation_plan.run_grouped(grouped)
+            for agg_timestamp, interval_result in interval_results.items():
                 self.result = {"start_timestamp": int(agg_timestamp)}
-                self.process_data_per_ctxt(
-                    self.dataframe[self.dataframe["aggregated_time"] == agg_timestamp])
+                self.result.update(interval_result)
                 self.result_map.append(self.result)
         else:
             self.result = {}
@@ -328,3 +447,205 @@ class Aggregator:
             self.result_map.append(self.result)
 
         return self.result_map
+
+    def process_data_in_chunks(self) -> dict:
+        """
+        reads the input data one chunk at a time and folds each chunk
+        into running accumulators per interval, so that only one chunk
+        and the state of each interval are held in memory
+        """
+        accumulators = {}
+
+        for chunk in self.data_chunks:
+            self.dataframe = chunk
+            self.accumulate_chunk(accumulators, chunk)
+
+        self.dataframe = None
+        self.data_chunks = None
+        logger.debug("unique time intervals in the dataset: %s",
+                     list(accumulators.keys()))
+
+        return self.finalize_accumulators(accumulators)
+
+    def accumulate_chunk(self, accumulators, chunk):
+        """
+        folds the chunk into accumulators, dict of
+        interval start timestamp -> IntervalAccumulator
+        """
+        if self.provision_metadata.aggregation_interval > 0:
+            self.set_aggregated_time(chunk)
+            for agg_time, df_ctxt in chunk.groupby("aggregated_time", sort=False):
+                agg_timestamp = int(agg_time)
+                if agg_timestamp not in accumulators:
+                    accumulators[agg_timestamp] = IntervalAccumulator(
+                        self.provision_metadata)
+                accumulators[agg_timestamp].update(df_ctxt)
+        else:
+            if None not in accumulators:
+                accumulators[None] = IntervalAccumulator(
+                    self.provision_metadata)
+            accumulators[None].update(chunk)
+
+    def finalize_accumulators(self, accumulators, in_time_order=False) -> dict:
+        """
+        adds the result of each interval accumulator to the result_map,
+        in the order of the intervals in the input, or in time order,
+        say when the accumulators are from many input files
+
+        with state-store-dir, the accumulators are folded into the
+        state store and only the final intervals are added
+        """
+        if self.provision_metadata.state_store_dir is not None:
+            accumulators = self.fold_into_state_store(accumulators)
+            in_time_order = True
+
+        return self.append_results(accumulators, in_time_order)
+
+    def get_stream_key(self) -> str:
+        """
+        returns the key of the stream in the state store
+        """
+        if self.stream_metadata.stream_id is None:
+            return "default"
+        return str(self.stream_metadata.stream_id)
+
+    def fold_into_state_store(self, accumulators) -> dict:
+        """
+        folds the interval accumulators into the state store
+        and returns the accumulators of the final intervals
+        """
+        if self.provision_metadata.aggregation_interval <= 0:
+            logger.warning(
+                "state-store-dir needs aggregation-interval, results are not stored")
+            return accumulators
+
+        try:
+            store = IntervalStateStore(
+                self.provision_metadata.state_store_dir, self.provision_metadata)
+            try:
+                final_accumulators = store.fold(
+                    self.get_stream_key(), accumulators,
+                    self.provision_metadata.watermark_delay)
+            finally:
+                store.close()
+        except Exception as err:
+            # results of the input are returned as is, not to lose them
+            logger.error("folding into state store failed: %s",
+                         self.provision_metadata.state_store_dir)
+            logger.error("%s: %s", type(err), err)
+            return accumulators
+
+        logger.debug("intervals folded: %s, final intervals: %s",
+                     list(accumulators.keys()), list(final_accumulators.keys()))
+        return final_accumulators
+
+    def flush_state_store(self) -> dict:
+        """
+        adds the results of all the intervals in the state store,
+        final or not, to the result_map and removes them from the store,
+        say at the end of a backfill
+        """
+        if self.provision_metadata.state_store_dir is None:
+            logger.warning("state-store-dir is not provisioned")
+            return self.result_map
+
+        store = IntervalStateStore(
+            self.provision_metadata.state_store_dir, self.provision_metadata)
+        try:
+            accumulators = store.flush(self.get_stream_key())
+        finally:
+            store.close()
+        return self.append_results(accumulators, in_time_order=True)
+
+    def append_results(self, accumulators, in_time_order=False) -> dict:
+        """
+        adds the result of each interval accumulator to the result_map
+        """
+        if in_time_order:
+            accumulators = dict(sorted(
+                accumulators.items(), key=lambda item: item[0] or 0))
+
+        for agg_timestamp, accumulator in accumulators.items():
+            self.result = {}
+            if agg_timestamp is not None:
+                self.result["start_timestamp"] = agg_timestamp
+            self.result.update(accumulator.finalize())
+            if self.provision_metadata.partial_state:
+                self.result["partial_state"] = accumulator.serialize()
+            self.result_map.append(self.result)
+
+        return self.result_map
+
+    def accumulate_input_file(self, accumulators, input_file, bucket_name=None,
+                              lock=None) -> int:
+        """
+        reads the input file and folds its dataframe, or its chunks,
+        into accumulators, holding the lock if given while folding,
+        returns the number of rows of the file
+        """
+        input_data = self.read_input_file(input_file, bucket_name)
+        if input_data is None:
+            return 0
+        if self.provision_metadata.chunk_size <= 0:
+            input_data = [input_data]
+
+        rows = 0
+        for chunk in input_data:
+            rows += len(chunk.index)
+            if lock is None:
+                self.accumulate_chunk(accumulators, chunk)
+            else:
+                with lock:
+                    self.accumulate_chunk(accumulators, chunk)
+        return rows
+
+    def merge_accumulators(self, accumulators, other_accumulators):
+        """
+        merges the interval accumulators of other_accumulators, say of
+        another input file, into accumulators of the same intervals
+        """
+        for agg_timestamp, accumulator in other_accumulators.items():
+            if agg_timestamp in accumulators:
+                accumulators[agg_timestamp].merge(accumulator)
+            else:
+                accumulators[agg_timestamp] = accumulator
+        return accumulators
+
+    def process_input_files(self, input_files) -> dict:
+        """
+        aggregates many input files, list of (input file, bucket name),
+        say all the records of a batched S3 event
+
+        input_files_concurrency files are downloaded and parsed at a time
+        on a thread pool, and their chunks are folded into the same
+        accumulators, so that the results of an interval spread
+        across the files are merged
+        """
+        accumulators = {}
+        accumulators_lock = threading.Lock()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(self.input_files_concurrency, 1)) as executor:
+            futures = {
+                executor.submit(
+                    self.accumulate_input_file, accumulators, input_file,
+                    bucket_name, accumulators_lock
+                ): input_file
+                for input_file, bucket_name in input_files
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as err:
+                    logger.error("aggregating %s failed", futures[future])
+                    logger.error("%s: %s", type(err), err)
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                logger.debug("aggregated %s", futures[future])
+
+        logger.debug("unique time intervals in the input files: %s",
+                     list(accumulators.keys()))
+
+        # files are completed in any order
+        return self.finalize_accumulators(accumulators, in_time_order=True)
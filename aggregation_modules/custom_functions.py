@@ -16,16 +16,36 @@
 defines all custom functions to aggregate the data
 New custom functions can to be added here
 """
-import json
+import base64
+import functools
 import logging
 import os
+import re
 import time
+import numpy as np
 import pandas as pd
 
-import httpagentparser
+from aggregation_modules.sketches import HyperLogLog, TDigest
 
 logger = logging.getLogger(__name__)
 
+# details extracted from the user agent strings
+UA_INFO = (
+    "os",
+    "browser",
+    "platform",
+)
+
+# max number of distinct user agent strings
+# to keep the parsed details for
+UA_CACHE_SIZE = 65536
+
+# number of counters tracked for each of the top k values
+TOP_K_CAPACITY_FACTOR = 25
+
+# quantile functions, say p95 for the 95th percentile or p99.9
+QUANTILE_FUNCTION = re.compile(r"^p(100|\d{1,2}(\.\d+)?)$")
+
 
 def convert_time(epoch_time, time_format="%s", delta=1):
     """
@@ -59,6 +79,31 @@ def convert_time(epoch_time, time_format="%s", delta=1):
     return time.strftime(time_format, time.gmtime(float(epoch_rounded)))
 
 
+def convert_time_to_interval(epoch_df, delta=1):
+    """
+    Vectorized form of convert_time for a column of GMT epoch times.
+    Rounds off each epoch time to the start of its delta interval
+    using int64 arithmetic.
+    :param epoch_df: column of epoch times
+    :param delta: in seconds to be rounded off.
+                  example: 300, 1800, 3600...
+    :rtype: pd.Series of int64 epoch times
+    example:
+        >>> convert_time_to_interval(pd.Series([1541399309.143]), delta=300).tolist()
+        [1541399100]
+    """
+    # reset delta if unexpected value
+    if delta <= 0:
+        delta = 1
+    if pd.api.types.is_integer_dtype(epoch_df.dtype):
+        # int64, a smaller integer type overflows on % delta
+        epoch_time = epoch_df.to_numpy(dtype="int64")
+    else:
+        epoch_time = np.floor(epoch_df.to_numpy(dtype="float64")).astype("int64")
+    return pd.Series(epoch_time - epoch_time % int(delta),
+                     index=epoch_df.index, dtype="int64")
+
+
 def convert_to_numeric(input_df):
     return pd.to_numeric(input_df, errors='coerce').fillna(0)
 
@@ -67,38 +112,116 @@ def replace_string(input_df, from_str, to_str):
     return input_df.replace(from_str, to_str)
 
 
+# pandas function names of the basic aggregations
+BASE_AGGREGATES = {
+    "sum": "sum",
+    "min": "min",
+    "max": "max",
+    "mean": "mean",
+    "median": "median",
+    "variance": "var",
+    "any": "any",
+    "count": "count",
+}
+
+
 def cal_base_aggregates(lst, input_df):
     """
     Used to calculate basic aggregations
     sum(), min(), max(), mean(), median(), any(), count()
     """
     out = 0
-    if lst == "sum":
-        out = input_df.sum()
-    if lst == "min":
-        out = input_df.min()
-    if lst == "max":
-        out = input_df.max()
-    if lst == "mean":
-        out = input_df.mean()
-    if lst == "median":
-        out = input_df.median()
-    if lst == "variance":
-        out = input_df.var()
-    if lst == "any":
-        out = input_df.any()
-    if lst == "count":
-        out = input_df.count()
+    if lst in BASE_AGGREGATES:
+        out = getattr(input_df, BASE_AGGREGATES[lst])()
     return float(out)
 
 
-def get_unique_counts_of_column(input_df) -> dict:
+def cal_fused_base_aggregates(lst, input_df) -> dict:
+    """
+    Used to calculate basic aggregations, same as cal_base_aggregates,
+    for the list of functions in a single Series.agg call
+    returns dict of function -> value
+    """
+    functions = [func for func in dict.fromkeys(lst) if func in BASE_AGGREGATES]
+    out = {}
+    if functions:
+        aggregates = input_df.agg([BASE_AGGREGATES[func] for func in functions])
+        out = dict(zip(functions, aggregates.tolist()))
+
+    # unsupported functions are set to 0 as in cal_base_aggregates
+    return {func: float(out.get(func, 0)) for func in lst}
+
+
+def cal_grouped_base_aggregates(lst, grouped_df) -> dict:
+    """
+    Used to calculate basic aggregations, same as cal_base_aggregates,
+    of a grouped column for all the groups in a single pass
+    returns dict of group -> {function: value}
+    """
+    functions = [func for func in dict.fromkeys(lst) if func in BASE_AGGREGATES]
+    if functions:
+        aggregates = grouped_df.agg([BASE_AGGREGATES[func] for func in functions])
+        aggregates.columns = functions
+    else:
+        aggregates = pd.DataFrame(index=grouped_df.size().index)
+
+    # unsupported functions are set to 0 as in cal_base_aggregates
+    for func in lst:
+        if func not in aggregates.columns:
+            aggregates[func] = 0
+
+    return aggregates.astype("float64").to_dict("index")
+
+
+def get_quantile(function):
+    """
+    returns the quantile of the quantile function, say 0.95 for p95,
+    or None when function is not a quantile function
+    """
+    if not isinstance(function, str) or not QUANTILE_FUNCTION.match(function):
+        return None
+    return float(function[1:]) / 100
+
+
+def cal_quantiles(lst, input_df, compression=100) -> dict:
+    """
+    Used to calculate the quantile functions, say p50, p95, p99,
+    estimated with a t-digest sketch of the column
+    returns dict of function -> value
     """
-    returns json formatted output of
-    distinct counts of the input dataframe column
+    sketch = TDigest(compression).add_values(input_df)
+    return {func: sketch.quantile(get_quantile(func)) for func in lst}
+
+
+def get_value_counts(input_df) -> pd.Series:
+    """
+    returns distinct counts of the input dataframe column,
+    where integral values of float columns, say bigint
+    columns with missing values, are indexed as int64
+    and categories not in category columns are dropped
     """
     buffer = input_df.value_counts()
-    return json.loads(buffer.to_json())
+    if isinstance(buffer.index, pd.CategoricalIndex):
+        buffer = buffer[buffer > 0]
+        buffer.index = buffer.index.astype(buffer.index.categories.dtype)
+    if pd.api.types.is_float_dtype(buffer.index.dtype) and (buffer.index % 1 == 0).all():
+        buffer.index = buffer.index.astype("int64")
+    return buffer
+
+
+def get_unique_counts_from_counts(value_counts) -> dict:
+    """
+    returns dict of the value counts of a column
+    """
+    return dict(zip(value_counts.index.tolist(), value_counts.tolist()))
+
+
+def get_unique_counts_of_column(input_df) -> dict:
+    """
+    returns dict of distinct counts of the input dataframe column,
+    with int keys for bigint columns
+    """
+    return get_unique_counts_from_counts(get_value_counts(input_df))
 
 
 def get_status_code_fillers():
@@ -128,16 +251,51 @@ def get_status_code_level_hit_counts(status_code_df):
     ```
     """
 
+    return get_status_code_levels_from_counts(get_value_counts(status_code_df))
+
+
+def get_numeric_counts(value_counts) -> tuple:
+    """
+    returns (int64 values, counts) of the numeric values
+    of the value counts, other values are dropped
+    """
+    values = pd.to_numeric(
+        pd.Series(value_counts.index, dtype="object"), errors="coerce").to_numpy()
+    numeric = ~np.isnan(values.astype("float64"))
+    return (values[numeric].astype("int64"),
+            value_counts.to_numpy()[numeric].astype("int64"))
+
+
+def get_status_code_levels_from_counts(status_code_counts) -> dict:
+    """
+    returns hits_{2,3,4,5}xx from the value counts
+    of the statuscode column
+    """
     mdata = get_status_code_fillers()
-    uniq_status_code_counts = get_unique_counts_of_column(status_code_df)
-    for status_code, st_count in uniq_status_code_counts.items():
-        status_code_prefix = int(int(status_code) / 100)
-        if status_code_prefix in [2, 3, 4, 5]:
-            mdata["hits_" + str(status_code_prefix) + "xx"] += st_count
+    status_codes, counts = get_numeric_counts(status_code_counts)
+
+    # hits per status code class, say 2 for 2xx
+    status_code_prefix = status_codes // 100
+    in_range = (status_code_prefix >= 2) & (status_code_prefix <= 5)
+    class_counts = np.bincount(
+        status_code_prefix[in_range], weights=counts[in_range], minlength=6)
+    for prefix in [2, 3, 4, 5]:
+        mdata["hits_" + str(prefix) + "xx"] = int(class_counts[prefix])
 
     return mdata
 
 
+def get_total_hits(input_df):
+    """
+    total number of requests
+    sample output,
+    ```
+      "total_hits": 30,
+    ```
+    """
+    return len(input_df.index)
+
+
 def get_traffic_volume(totalbytes_df):
     """
     sum of totalbytes column
@@ -146,7 +304,34 @@ def get_traffic_volume(totalbytes_df):
       "traffic_volume": 97230,
     ```
     """
-    return int(totalbytes_df.sum())
+    return get_traffic_volume_from_sum(totalbytes_df.sum())
+
+
+def get_traffic_volume_from_sum(totalbytes_sum):
+    """
+    traffic_volume from the sum of totalbytes column
+    """
+    return int(totalbytes_sum)
+
+
+def count_cache_status_from_counts(cache_counts) -> tuple:
+    """
+    returns (cache hits, cache misses, total hits)
+    from the value counts of the cachestatus column
+    """
+    cache_status, counts = get_numeric_counts(cache_counts)
+    return (int(counts[cache_status == 1].sum()),
+            int(counts[cache_status == 0].sum()),
+            int(counts.sum()))
+
+
+def get_offload_rate(cache_hits, total_hits) -> float:
+    """
+    offload rate as, total cache hits * 100 / total hits
+    """
+    if total_hits == 0:
+        return float("nan")
+    return cache_hits * 100.00 / total_hits
 
 
 def cal_cache_status(cache_df):
@@ -161,10 +346,18 @@ def cal_cache_status(cache_df):
     }
     ```
     """
-    uniq_cache_counts = get_unique_counts_of_column(cache_df)
+    return cal_cache_status_from_counts(get_value_counts(cache_df))
+
+
+def cal_cache_status_from_counts(cache_counts):
+    """
+    returns dict of cache_hit and cache_miss
+    from the value counts of the cachestatus column
+    """
+    cache_hits, cache_misses, _ = count_cache_status_from_counts(cache_counts)
     cache = {}
-    cache["cache_hit"] = uniq_cache_counts.get("1", 0)
-    cache["cache_miss"] = uniq_cache_counts.get("0", 0)
+    cache["cache_hit"] = cache_hits
+    cache["cache_miss"] = cache_misses
     return cache
 
 
@@ -177,7 +370,15 @@ def cal_offload_rate(cache_df):
       "offload_rate": 80.0,
     ```
     """
-    return cache_df[cache_df == 1].sum() * 100.00 / cache_df.count()
+    return cal_offload_rate_from_counts(get_value_counts(cache_df))
+
+
+def cal_offload_rate_from_counts(cache_counts):
+    """
+    offload rate from the value counts of the cachestatus column
+    """
+    cache_hits, _, total_hits = count_cache_status_from_counts(cache_counts)
+    return get_offload_rate(cache_hits, total_hits)
 
 
 def cal_origin_responsetime(dfs):
@@ -190,27 +391,46 @@ def cal_origin_responsetime(dfs):
       "origin_response_time": 0,
     ```
     """
-    return int(
-        dfs.query("cachestatus == 0 and cacherefreshsrc == 'origin'")[
-            "turnaroundtimemsec"
-        ].sum()
+    return cal_origin_responsetime_from_masks(
+        dfs["cachestatus"] == 0,
+        dfs["cacherefreshsrc"] == "origin",
+        dfs["turnaroundtimemsec"],
     )
 
 
-def extract_from_ua(ua_string, to_extract):
+def cal_origin_responsetime_from_masks(cache_miss_mask, origin_mask, turnaround_df):
     """
-    extracts requested info from User Agent String
+    origin_responsetime from the masks of the rows where
+    cachestatus == 0 and cacherefreshsrc == 'origin'
     """
+    return int(turnaround_df[cache_miss_mask & origin_mask].sum())
+
+
+@functools.lru_cache(maxsize=UA_CACHE_SIZE)
+def classify_user_agent(ua_string) -> tuple:
+    """
+    parses the User Agent String once and returns the
+    (os, browser, platform) names, results are cached
+    for the most recently seen user agents
+    httpagentparser is imported only when user agents are parsed
+    """
+    import httpagentparser
+
     client_info = httpagentparser.detect(ua_string)
-    if to_extract in client_info:
-        if client_info[to_extract]["name"] is not None:
-            return client_info[to_extract]["name"]
-    return str("invalid")
+    ua_details = []
+    for to_extract in UA_INFO:
+        name = "invalid"
+        if to_extract in client_info and client_info[to_extract]["name"] is not None:
+            name = client_info[to_extract]["name"]
+        ua_details.append(name)
+    return tuple(ua_details)
 
 
 def parse_user_agent(user_agent):
     """
     returns platform, os, browser distribution details.
+    each distinct user agent is classified once and its
+    details are weighted by the hits of the user agent
     sample output,
     ```
     "platform": {
@@ -224,19 +444,26 @@ def parse_user_agent(user_agent):
     }
     ```
     """
-    ua_info = (
-        "os",
-        "browser",
-        "platform",
+    return parse_user_agent_from_counts(get_value_counts(user_agent))
+
+
+def parse_user_agent_from_counts(ua_counts):
+    """
+    returns platform, os, browser distribution details
+    from the value counts of the ua column
+    """
+    hits = pd.Series(ua_counts.to_numpy())
+    ua_details = pd.DataFrame(
+        [classify_user_agent(ua_string) for ua_string in ua_counts.index],
+        columns=UA_INFO,
     )
+
     client_info = {}
-    for to_extract in ua_info:
-        client_info[to_extract] = user_agent.apply(
-            extract_from_ua, args=(to_extract,))
-        # convert to json
-        client_info[to_extract] = json.loads(
-            client_info[to_extract].value_counts().to_json()
-        )
+    for to_extract in UA_INFO:
+        counts = hits.groupby(ua_details[to_extract]).sum()
+        counts = counts[counts > 0].sort_values(ascending=False, kind="stable")
+        client_info[to_extract] = {
+            name: int(count) for name, count in counts.items()}
     return client_info
 
 
@@ -254,6 +481,28 @@ def parse_unique_count_for_column(column_df, column):
     return {column: get_unique_counts_of_column(column_df)}
 
 
+def get_top_k_from_counts(value_counts, column, k=10) -> dict:
+    """
+    returns the exact counts of the k most frequent values of the column
+    from its value counts, and the summed counts of the other values
+    in <column>_others, kept apart from the counts so that it cannot
+    collide with a value of the column, say "others" set for "-"
+    """
+    top = value_counts.nlargest(k)
+    return {
+        column: get_unique_counts_from_counts(top),
+        get_top_k_others_key(column): int(value_counts.sum() - top.sum()),
+    }
+
+
+def get_top_k_others_key(column) -> str:
+    """
+    returns the output key of the summed counts
+    of the values not in the top-k of the column
+    """
+    return str(column) + "_others"
+
+
 def calc_unique_visitor(dfs):
     """
     returns total number of unique visitor     calculation should be done based on Client IP and UserAgent.
@@ -268,3 +517,77 @@ def calc_unique_visitor(dfs):
                 unique_visitors.add((user_agent, client_ip))
         result["unique_visitors_value"] = list(unique_visitors)
         return result
+
+
+def hash_unique_visitors(dfs) -> np.ndarray:
+    """
+    returns the sorted distinct 64 bit hashes of the
+    (user_agent, client_ip) pairs of the dataframe
+    hashes are stable across runs, so keys of different
+    intervals and files can be merged
+    """
+    if dfs is None or dfs.empty:
+        return np.array([], dtype="<u8")
+    keys = pd.util.hash_pandas_object(dfs, index=False).to_numpy()
+    return np.unique(keys).astype("<u8")
+
+
+def encode_unique_visitor_keys(keys) -> str:
+    """
+    returns base64 of the little endian uint64 keys
+    """
+    return base64.b64encode(np.asarray(keys, dtype="<u8").tobytes()).decode("ascii")
+
+
+def decode_unique_visitor_keys(encoded_keys) -> np.ndarray:
+    """
+    returns the uint64 keys from encode_unique_visitor_keys output
+    """
+    return np.frombuffer(base64.b64decode(encoded_keys), dtype="<u8")
+
+
+def merge_unique_visitor_keys(*keys) -> np.ndarray:
+    """
+    returns the sorted union of uint64 key arrays
+    """
+    if not keys:
+        return np.array([], dtype="<u8")
+    return np.unique(np.concatenate(keys)).astype("<u8")
+
+
+def calc_unique_visitor_hashed(dfs):
+    """
+    returns the exact total number of unique visitors based on Client IP
+    and UserAgent, along with the compact binary keys of the visitors
+    instead of the list of (user_agent, client_ip)
+    sample output,
+    ```
+      "unique_visitors": 1,
+      "unique_visitors_keys": "<base64 of sorted uint64 keys>",
+    ```
+    """
+    keys = hash_unique_visitors(dfs)
+    return {
+        "unique_visitors": len(keys),
+        "unique_visitors_keys": encode_unique_visitor_keys(keys),
+    }
+
+
+def calc_unique_visitor_sketch(dfs, precision=12):
+    """
+    returns the approximate total number of unique visitors based on
+    Client IP and UserAgent, along with the serialized HyperLogLog sketch
+    of the visitors, that can be merged across intervals and files
+    sample output,
+    ```
+      "unique_visitors": 1,
+      "unique_visitors_sketch": "<base64 of HyperLogLog registers>",
+    ```
+    """
+    sketch = HyperLogLog(precision)
+    if dfs is not None and not dfs.empty:
+        sketch.add_hashes(pd.util.hash_pandas_object(dfs, index=False).to_numpy())
+    return {
+        "unique_visitors": sketch.count(),
+        "unique_visitors_sketch": sketch.serialize(),
+    }
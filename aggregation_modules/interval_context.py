@@ -0,0 +1,100 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+holds the dataframe of an interval along with the intermediates,
+say value counts, masks and sums of the columns, that are shared
+by the functions aggregating the interval
+"""
+
+import logging
+
+from aggregation_modules import custom_functions
+
+logger = logging.getLogger(__name__)
+
+
+def get_column(dataframe, column):
+    """
+    returns the column of the dataframe
+    """
+    return dataframe[column]
+
+
+def get_mask(dataframe, column, value):
+    """
+    returns boolean mask of the rows where column equals value
+    """
+    return dataframe[column] == value
+
+
+def get_sum(dataframe, column):
+    """
+    returns sum of the column
+    """
+    return dataframe[column].sum()
+
+
+def get_value_counts(dataframe, column):
+    """
+    returns distinct counts of the column
+    """
+    return custom_functions.get_value_counts(dataframe[column])
+
+
+# intermediates that can be requested by key,
+# each function is called with the dataframe and the key arguments
+INTERMEDIATES = {
+    "column": get_column,
+    "mask": get_mask,
+    "sum": get_sum,
+    "value_counts": get_value_counts,
+}
+
+
+class IntervalContext:
+    """
+    dataframe of an interval and its shared intermediates,
+    each intermediate is computed once, on first request,
+    and kept until the interval is finished
+    """
+
+    def __init__(self, dataframe):
+        self.dataframe = dataframe
+        self.intermediates = {}
+
+    def get(self, key, *args):
+        """
+        returns the intermediate key for the args,
+        say get("value_counts", "statuscode")
+        """
+        memo_key = (key,) + args
+        if memo_key not in self.intermediates:
+            self.intermediates[memo_key] = INTERMEDIATES[key](
+                self.dataframe, *args)
+        return self.intermediates[memo_key]
+
+    def set(self, value, key, *args):
+        """
+        sets an intermediate that is already computed,
+        say set(1234, "sum", "totalbytes")
+        """
+        self.intermediates[(key,) + args] = value
+
+    def clear(self):
+        """
+        evicts all the intermediates and the dataframe
+        """
+        self.intermediates = {}
+        self.dataframe = None
@@ -20,8 +20,39 @@ necessary fields that will be used for aggregation.
 import logging
 import json
 
+from aggregation_modules.sketches import HyperLogLog, TDigest
+
 logger = logging.getLogger(__name__)
 
+# provision keys that configure the aggregation
+# and are not dataset field names
+PROVISION_OPTIONS = [
+    "custom-functions",
+    "aggregation-interval",
+    "chunk-size",
+    "unique-visitor-mode",
+    "unique-visitor-precision",
+    "top-k",
+    "parse-engine",
+    "partial-state",
+    "state-store-dir",
+    "watermark-delay",
+    "quantile-compression",
+]
+
+# supported values of unique-visitor-mode
+UNIQUE_VISITOR_MODES = [
+    "list",
+    "hashed",
+    "hll",
+]
+
+# supported values of parse-engine for STRUCTURED format
+PARSE_ENGINES = [
+    "pandas",
+    "pyarrow",
+]
+
 
 class ProvisionMetadata:
     """
@@ -33,6 +64,21 @@ class ProvisionMetadata:
         self.fields_to_aggregate = {}
         self.custom_functions = {}
         self.aggregation_interval = -1
+        self.chunk_size = -1
+        self.unique_visitor_mode = "list"
+        self.unique_visitor_precision = 12
+        # field -> number of most frequent values for unique_counts
+        self.top_k = {}
+        # compression of the t-digest sketch of the quantile functions
+        self.quantile_compression = 100
+        self.parse_engine = "pandas"
+        # add the mergeable partial state to the result of each interval
+        self.partial_state = False
+        # directory of the interval state store, disabled when None
+        self.state_store_dir = None
+        # secs after the end of an interval to wait for its late data,
+        # one aggregation interval when None
+        self.watermark_delay = None
 
     def __str__(self) -> str:
         return f"ProvisionMetadata obj, fields={self.fields_to_aggregate}, custom_fields={self.custom_functions}"
@@ -52,7 +98,7 @@ class ProvisionMetadata:
         # basic aggregate functions and custom functions
         for func_name in self.__data.keys():
 
-            if func_name not in ["custom-functions", "aggregation-interval"]:
+            if func_name not in PROVISION_OPTIONS:
                 self.fields_to_aggregate[func_name] = {
                     "funcs": self.__data[func_name],
                 }
@@ -63,6 +109,82 @@ class ProvisionMetadata:
                     # add reqtimesec to the required field set
                     self.fields_to_aggregate["reqtimesec"] = {"funcs": []}
 
+            if func_name == "chunk-size":
+                # number of rows to read and aggregate at a time,
+                # -1 reads the whole input file at once
+                if (isinstance(self.__data[func_name], int)
+                        and (self.__data[func_name] > 0
+                             or self.__data[func_name] == -1)):
+                    self.chunk_size = self.__data[func_name]
+                else:
+                    logger.warning(
+                        "chunk-size invalid: %s, using: %s",
+                        self.__data[func_name], self.chunk_size)
+
+            if func_name == "unique-visitor-mode":
+                if self.__data[func_name] in UNIQUE_VISITOR_MODES:
+                    self.unique_visitor_mode = self.__data[func_name]
+                else:
+                    logger.warning(
+                        "unique-visitor-mode invalid: %s, using: %s",
+                        self.__data[func_name], self.unique_visitor_mode)
+
+            if func_name == "unique-visitor-precision":
+                # HyperLogLog sketch uses 2^precision registers
+                if (isinstance(self.__data[func_name], int)
+                        and HyperLogLog.MIN_PRECISION <= self.__data[func_name]
+                        <= HyperLogLog.MAX_PRECISION):
+                    self.unique_visitor_precision = self.__data[func_name]
+                else:
+                    logger.warning(
+                        "unique-visitor-precision invalid: %s, using: %s",
+                        self.__data[func_name], self.unique_visitor_precision)
+
+            if func_name == "quantile-compression":
+                # t-digest sketch keeps about compression / 2 centroids
+                if (isinstance(self.__data[func_name], int)
+                        and TDigest.MIN_COMPRESSION <= self.__data[func_name]
+                        <= TDigest.MAX_COMPRESSION):
+                    self.quantile_compression = self.__data[func_name]
+                else:
+                    logger.warning(
+                        "quantile-compression invalid: %s, using: %s",
+                        self.__data[func_name], self.quantile_compression)
+
+            if func_name == "top-k":
+                for field, k in self.__data[func_name].items():
+                    if isinstance(k, int) and k > 0:
+                        self.top_k[field.lower()] = k
+                    else:
+                        logger.warning("top-k invalid for %s: %s", field, k)
+
+            if func_name == "parse-engine":
+                if self.__data[func_name] in PARSE_ENGINES:
+                    self.parse_engine = self.__data[func_name]
+                else:
+                    logger.warning(
+                        "parse-engine invalid: %s, using: %s",
+                        self.__data[func_name], self.parse_engine)
+
+            if func_name == "partial-state":
+                if isinstance(self.__data[func_name], bool):
+                    self.partial_state = self.__data[func_name]
+                else:
+                    logger.warning(
+                        "partial-state invalid: %s, using: %s",
+                        self.__data[func_name], self.partial_state)
+
+            if func_name == "state-store-dir":
+                self.state_store_dir = self.__data[func_name]
+
+            if func_name == "watermark-delay":
+                if isinstance(self.__data[func_name], int) and self.__data[func_name] >= 0:
+                    self.watermark_delay = self.__data[func_name]
+                else:
+                    logger.warning(
+                        "watermark-delay invalid: %s, using: %s",
+                        self.__data[func_name], self.watermark_delay)
+
             if func_name == "custom-functions":
                 for function in self.__data["custom-functions"]:
                     if function not in all_custom_functions:
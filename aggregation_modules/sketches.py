@@ -0,0 +1,370 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+mergeable sketches that summarize a column in bounded memory,
+serialized to base64 strings so they can be stored along with
+the results and merged across intervals and files
+"""
+
+import base64
+import json
+import logging
+import math
+import zlib
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def bit_length(values) -> np.ndarray:
+    """
+    returns the number of bits needed to represent each uint64 value
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    # frexp exponent is the bit length, exact for 32 bit values
+    return np.where(high > 0, np.frexp(high)[1] + 32, np.frexp(low)[1])
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch to estimate the number of distinct 64 bit hashes,
+    uses 2^precision one byte registers with a standard error of
+    about 1.04 / sqrt(2^precision)
+    """
+
+    MIN_PRECISION = 4
+    MAX_PRECISION = 18
+
+    def __init__(self, precision=12):
+        if not self.MIN_PRECISION <= precision <= self.MAX_PRECISION:
+            raise ValueError(
+                f"precision should be between {self.MIN_PRECISION} "
+                f"and {self.MAX_PRECISION}: {precision}")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def add_hashes(self, hashes):
+        """
+        adds the uint64 hashes to the sketch
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if hashes.size == 0:
+            return self
+
+        # first precision bits select the register and
+        # the rest gives the position of the leftmost 1 bit
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        remaining = hashes << np.uint64(self.precision)
+        rank = np.minimum(
+            64 - bit_length(remaining) + 1, 64 - self.precision + 1
+        ).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+        return self
+
+    def merge(self, other):
+        """
+        merges the other sketch into this sketch
+        """
+        if other.precision != self.precision:
+            raise ValueError(
+                f"cannot merge sketches of precision {self.precision} "
+                f"and {other.precision}")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self) -> int:
+        """
+        returns the estimated number of distinct hashes added
+        """
+        num_registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        if num_registers == 16:
+            alpha = 0.673
+        elif num_registers == 32:
+            alpha = 0.697
+        elif num_registers == 64:
+            alpha = 0.709
+
+        estimate = alpha * num_registers * num_registers / np.sum(
+            np.ldexp(1.0, -self.registers.astype(np.int64)))
+
+        # linear counting for small cardinalities
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * num_registers and zeros > 0:
+            estimate = num_registers * math.log(num_registers / zeros)
+        return int(round(estimate))
+
+    def serialize(self) -> str:
+        """
+        returns the sketch as base64 string
+        """
+        payload = bytes([self.precision]) + self.registers.tobytes()
+        return base64.b64encode(zlib.compress(payload)).decode("ascii")
+
+    @classmethod
+    def deserialize(cls, serialized):
+        """
+        returns the sketch from the serialize output
+        """
+        payload = zlib.decompress(base64.b64decode(serialized))
+        sketch = cls(payload[0])
+        sketch.registers = np.frombuffer(payload[1:], dtype=np.uint8).copy()
+        return sketch
+
+
+class SpaceSaving:
+    """
+    Space-Saving sketch of the most frequent values of a column,
+    keeps at most capacity counters, where each count overestimates
+    the true count by at most its error
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError(f"capacity should be positive: {capacity}")
+        self.capacity = capacity
+        self.total = 0
+        self.counts = pd.Series(dtype="int64")
+        self.errors = pd.Series(dtype="int64")
+
+    def get_floor(self) -> int:
+        """
+        returns the max count of any value that is not tracked
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+        return int(self.counts.min())
+
+    def merge_counts(self, counts, errors, floor, total):
+        """
+        merges the counters of another summary, values missing from
+        either summary are counted with the floor of that summary
+        """
+        values = self.counts.index.union(counts.index, sort=False)
+        self_floor = self.get_floor()
+        merged_counts = (self.counts.reindex(values, fill_value=self_floor)
+                         + counts.reindex(values, fill_value=floor))
+        merged_errors = (self.errors.reindex(values, fill_value=self_floor)
+                         + errors.reindex(values, fill_value=floor))
+
+        # keep the counters of the most frequent values
+        self.counts = merged_counts.sort_values(
+            ascending=False, kind="stable").iloc[:self.capacity]
+        self.errors = merged_errors[self.counts.index]
+        self.total += total
+        return self
+
+    def update(self, counts):
+        """
+        adds the exact counts of a batch of values,
+        say value_counts() of a chunk of the column
+        """
+        counts = counts.astype("int64")
+        return self.merge_counts(
+            counts, pd.Series(0, index=counts.index, dtype="int64"),
+            0, int(counts.sum()))
+
+    def merge(self, other):
+        """
+        merges the other sketch into this sketch
+        """
+        return self.merge_counts(
+            other.counts, other.errors, other.get_floor(), other.total)
+
+    def get_guaranteed_counts(self) -> pd.Series:
+        """
+        returns the counts less their errors, lower bounds of
+        the true counts, in descending order
+        """
+        return (self.counts - self.errors).sort_values(
+            ascending=False, kind="stable")
+
+    def top_k(self, k) -> dict:
+        """
+        returns the guaranteed counts of the k most frequent values,
+        that are exact when the counts were never merged with another
+        summary's floor, the rest of the total is total - sum of the counts
+        """
+        top = self.get_guaranteed_counts().iloc[:k]
+        top = top[top > 0]
+        return dict(zip(top.index.tolist(), top.tolist()))
+
+    def serialize(self) -> str:
+        """
+        returns the sketch as base64 string
+        """
+        payload = json.dumps({
+            "capacity": self.capacity,
+            "total": self.total,
+            "values": self.counts.index.tolist(),
+            "counts": self.counts.tolist(),
+            "errors": self.errors.tolist(),
+        })
+        return base64.b64encode(zlib.compress(payload.encode("utf-8"))).decode("ascii")
+
+    @classmethod
+    def deserialize(cls, serialized):
+        """
+        returns the sketch from the serialize output
+        """
+        payload = json.loads(zlib.decompress(base64.b64decode(serialized)))
+        sketch = cls(payload["capacity"])
+        sketch.total = payload["total"]
+        sketch.counts = pd.Series(
+            payload["counts"], index=payload["values"], dtype="int64")
+        sketch.errors = pd.Series(
+            payload["errors"], index=payload["values"], dtype="int64")
+        return sketch
+
+
+class TDigest:
+    """
+    t-digest sketch of the distribution of a numeric column, keeps
+    about compression centroids (mean, weight), that are smaller
+    at the tails, down to single values at the ends, so that the
+    high quantiles, say p99.9, are the most accurate
+    """
+
+    MIN_COMPRESSION = 20
+    MAX_COMPRESSION = 1000
+
+    def __init__(self, compression=100):
+        if not self.MIN_COMPRESSION <= compression <= self.MAX_COMPRESSION:
+            raise ValueError(
+                f"compression should be between {self.MIN_COMPRESSION} "
+                f"and {self.MAX_COMPRESSION}: {compression}")
+        self.compression = compression
+        self.means = np.empty(0, dtype=np.float64)
+        self.weights = np.empty(0, dtype=np.float64)
+        self.minimum = math.nan
+        self.maximum = math.nan
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def count(self) -> int:
+        """
+        returns the number of values added
+        """
+        return int(round(self.weights.sum()))
+
+    def add_values(self, values):
+        """
+        adds the numeric values, say a chunk of the column,
+        to the sketch, missing values are skipped
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+
+        # repeated values, say msec timings, are added as one centroid
+        means, weights = np.unique(values, return_counts=True)
+        return self.add_centroids(means, weights.astype(np.float64))
+
+    def add_centroids(self, means, weights):
+        """
+        adds the centroids, say of another sketch,
+        and compresses the sketch
+        """
+        if len(means) == 0:
+            return self
+        self.minimum = np.nanmin([self.minimum, means.min()])
+        self.maximum = np.nanmax([self.maximum, means.max()])
+        self.means = np.concatenate([self.means, means])
+        self.weights = np.concatenate([self.weights, weights])
+        self.compress()
+        return self
+
+    def compress(self):
+        """
+        merges the adjacent centroids that fall in the same unit of the
+        scale function k(q) = k1(q) + k2(q), the sum of the arcsine scale
+        k1(q) = compression / (2 pi) * asin(2q - 1), that bounds the
+        centroids around the median, and the logarithmic scale
+        k2(q) = compression / Z(n) * log(q / (1 - q)), that bounds the
+        weight of the tail centroids, where k1 alone merges about
+        (pi / compression)^2 of the values into each end centroid
+        """
+        order = np.argsort(self.means, kind="stable")
+        means = self.means[order]
+        weights = self.weights[order]
+
+        cumulative = np.cumsum(weights)
+        total = cumulative[-1]
+        # between 0 and 1, exclusive, the centroid weights are positive
+        quantiles = (cumulative - weights / 2) / total
+        arcsine_scale = self.compression / (2 * math.pi) * np.arcsin(2 * quantiles - 1)
+        # Z(n) of the merging t-digest, so that k2 spans about
+        # compression / 2 units for any number of values n
+        normalizer = 4 * math.log(max(total / self.compression, 1)) + 24
+        log_scale = self.compression / normalizer * np.log(quantiles / (1 - quantiles))
+
+        buckets = np.floor(arcsine_scale + log_scale)
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(buckets)) + 1])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def merge(self, other):
+        """
+        merges the other sketch into this sketch
+        """
+        return self.add_centroids(other.means, other.weights)
+
+    def quantile(self, q) -> float:
+        """
+        returns the estimated q quantile, between 0 and 1,
+        interpolated between the centers of the centroids
+        """
+        if len(self.means) == 0:
+            return math.nan
+
+        total = self.weights.sum()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate([[0], centers, [total]])
+        values = np.concatenate([[self.minimum], self.means, [self.maximum]])
+        return float(np.interp(q * total, positions, values))
+
+    def serialize(self) -> str:
+        """
+        returns the sketch as base64 string
+        """
+        payload = np.concatenate([
+            [self.compression, self.minimum, self.maximum],
+            self.means,
+            self.weights,
+        ]).astype(np.float64).tobytes()
+        return base64.b64encode(zlib.compress(payload)).decode("ascii")
+
+    @classmethod
+    def deserialize(cls, serialized):
+        """
+        returns the sketch from the serialize output
+        """
+        payload = np.frombuffer(
+            zlib.decompress(base64.b64decode(serialized)), dtype=np.float64)
+        sketch = cls(int(payload[0]))
+        sketch.minimum, sketch.maximum = float(payload[1]), float(payload[2])
+        centroids = (len(payload) - 3) // 2
+        sketch.means = payload[3:3 + centroids].copy()
+        sketch.weights = payload[3 + centroids:].copy()
+        return sketch
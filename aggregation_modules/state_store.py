@@ -0,0 +1,184 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+local store of the partial states of the intervals, so that an interval
+spread across many input files is emitted once, as final, when the
+data of the later intervals shows it is complete
+"""
+
+import logging
+import os
+import sqlite3
+
+from aggregation_modules.accumulators import IntervalAccumulator
+
+logger = logging.getLogger(__name__)
+
+# name of the SQLite database in state-store-dir
+STATE_STORE_FILE = "interval_state.db"
+
+
+class IntervalStateStore:
+    """
+    partial states of the intervals in a SQLite database,
+    keyed by (stream id, interval start timestamp), along with
+    the watermark of each stream, the latest interval start folded
+
+    an interval is final when the watermark is at least
+    watermark_delay secs after the end of the interval, by default
+    one aggregation interval, so that input files overlapping
+    the next interval do not make late data
+    """
+
+    def __init__(self, state_dir, provision_metadata):
+        self.provision_metadata = provision_metadata
+        self.path = os.path.join(state_dir, STATE_STORE_FILE)
+        os.makedirs(state_dir, exist_ok=True)
+        # waits for the other processes folding into the store
+        self.connection = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS interval_state (
+                stream_id TEXT NOT NULL,
+                start_timestamp INTEGER NOT NULL,
+                partial_state TEXT NOT NULL,
+                PRIMARY KEY (stream_id, start_timestamp)
+            );
+            CREATE TABLE IF NOT EXISTS watermark (
+                stream_id TEXT PRIMARY KEY,
+                start_timestamp INTEGER NOT NULL
+            );
+            """
+        )
+
+    def close(self):
+        """
+        closes the database
+        """
+        self.connection.close()
+
+    def get_watermark(self, stream_id):
+        """
+        returns the latest interval start folded for the stream,
+        or None when nothing is folded
+        """
+        row = self.connection.execute(
+            "SELECT start_timestamp FROM watermark WHERE stream_id = ?",
+            (stream_id,),
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def get_last_final_start(self, watermark, watermark_delay=None) -> int:
+        """
+        returns the start of the latest interval that is final
+        for the watermark, watermark_delay is one aggregation
+        interval when None
+        """
+        aggregation_interval = self.provision_metadata.aggregation_interval
+        if watermark_delay is None:
+            watermark_delay = aggregation_interval
+        return watermark - aggregation_interval - watermark_delay
+
+    def fold(self, stream_id, accumulators, watermark_delay=None) -> dict:
+        """
+        merges accumulators, dict of interval start timestamp ->
+        IntervalAccumulator, into the stored partial states of the stream,
+        and returns the accumulators of the intervals that are final,
+        which are removed from the store
+        """
+        cursor = self.connection.cursor()
+        # write lock for the whole fold, so that concurrent
+        # folds of the same interval are not lost
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            watermark = self.get_watermark(stream_id)
+            for agg_timestamp, accumulator in accumulators.items():
+                if watermark is not None and agg_timestamp <= self.get_last_final_start(
+                        watermark, watermark_delay):
+                    logger.warning(
+                        "late data for final interval %s of stream %s, "
+                        "emitted as another result of the interval",
+                        agg_timestamp, stream_id)
+
+                row = cursor.execute(
+                    "SELECT partial_state FROM interval_state "
+                    "WHERE stream_id = ? AND start_timestamp = ?",
+                    (stream_id, agg_timestamp),
+                ).fetchone()
+                if row is not None:
+                    accumulator = IntervalAccumulator.deserialize(
+                        row[0], self.provision_metadata).merge(accumulator)
+                cursor.execute(
+                    "INSERT OR REPLACE INTO interval_state "
+                    "(stream_id, start_timestamp, partial_state) VALUES (?, ?, ?)",
+                    (stream_id, agg_timestamp, accumulator.serialize()),
+                )
+
+            if accumulators:
+                watermark = max([watermark or 0, *accumulators.keys()])
+                cursor.execute(
+                    "INSERT OR REPLACE INTO watermark (stream_id, start_timestamp) "
+                    "VALUES (?, ?)",
+                    (stream_id, watermark),
+                )
+
+            final_accumulators = {}
+            if watermark is not None:
+                final_accumulators = self.pop_intervals(
+                    cursor, stream_id,
+                    self.get_last_final_start(watermark, watermark_delay))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        return final_accumulators
+
+    def flush(self, stream_id) -> dict:
+        """
+        returns the accumulators of all the stored intervals
+        of the stream, final or not, and removes them from the store
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            final_accumulators = self.pop_intervals(cursor, stream_id)
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        return final_accumulators
+
+    def pop_intervals(self, cursor, stream_id, last_start=None) -> dict:
+        """
+        returns the accumulators of the intervals of the stream
+        starting at or before last_start, or of all the intervals,
+        and removes them from the store
+        """
+        query = "FROM interval_state WHERE stream_id = ?"
+        args = [stream_id]
+        if last_start is not None:
+            query += " AND start_timestamp <= ?"
+            args.append(last_start)
+
+        accumulators = {
+            agg_timestamp: IntervalAccumulator.deserialize(
+                partial_state, self.provision_metadata)
+            for agg_timestamp, partial_state in cursor.execute(
+                "SELECT start_timestamp, partial_state " + query
+                + " ORDER BY start_timestamp", args)
+        }
+        cursor.execute("DELETE " + query, args)
+        return accumulators
@@ -21,6 +21,19 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# low cardinality string fields that are loaded as category
+CATEGORICAL_FIELDS = [
+    "billingregion",
+    "cacherefreshsrc",
+    "city",
+    "country",
+    "proto",
+    "reqmethod",
+    "servercountry",
+    "state",
+    "tlsversion",
+]
+
 
 class Fields:
     def __init__(self, dataset_id, dataset_name, dataset_type):
@@ -32,6 +45,7 @@ class Fields:
 class StreamMetadata:
     def __init__(self):
 
+        self.stream_id = None
         self.stream_activation_status = None
         self.delimiter = None
         self.stream_format = None
@@ -69,6 +83,7 @@ class StreamMetadata:
         and name for the particular stream
         """
         try:
+            self.stream_id = stream_buffer.get("streamId")
             self.stream_activation_status = stream_buffer.get(
                 "activationStatus")
             if "config" in stream_buffer:
@@ -119,3 +134,17 @@ class StreamMetadata:
         for field in self.__chosen_fields:
             if field.name == field_name:
                 return field.dtype
+
+    def get_parse_dtypes(self, field_names) -> dict:
+        """
+        returns dict of field name -> dtype the field is parsed as,
+        "bigint", "string" or "category" for low cardinality strings
+        """
+        parse_dtypes = {}
+        for field_name in field_names:
+            dtype = self.get_data_type_for_field(field_name)
+            if dtype == "string" and field_name in CATEGORICAL_FIELDS:
+                dtype = "category"
+            if dtype is not None:
+                parse_dtypes[field_name] = dtype
+        return parse_dtypes
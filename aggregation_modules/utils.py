@@ -16,16 +16,146 @@
 common utility functions that are used for parsing config and data files
 """
 
+import contextlib
+import functools
+import gzip
 import io
 import json
 import logging
+import mmap
+import operator
 import os
+import time
 from pathlib import Path
 
 import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+# time in secs the metadata files are served from the cache before
+# they are revalidated, can be set with METADATA_CACHE_TTL env variable
+METADATA_CACHE_TTL = 60
+
+
+@functools.lru_cache(maxsize=None)
+def get_json_loads():
+    """
+    returns the function that parses a line of JSON format stream,
+    orjson.loads when the optional orjson is installed, or json.loads
+    orjson is imported on the first JSON format stream
+    """
+    try:
+        import orjson
+    except ImportError:
+        return json.loads
+    return orjson.loads
+
+
+@functools.lru_cache(maxsize=None)
+def import_pyarrow():
+    """
+    returns the optional pyarrow module, along with pyarrow.csv,
+    or None when it is not installed
+    pyarrow is imported on the first use of the pyarrow parse engine
+    """
+    try:
+        import pyarrow
+        import pyarrow.csv
+    except ImportError:
+        return None
+    return pyarrow
+
+
+class UnclosedFile:
+    """
+    file object that leaves the wrapped file open when closed,
+    for the readers that close their input, say pyarrow
+    """
+
+    def __init__(self, file_object):
+        self.file_object = file_object
+
+    def __getattr__(self, name):
+        return getattr(self.file_object, name)
+
+    def close(self):
+        """
+        the wrapped file is closed by its owner
+        """
+
+
+class StreamReader(io.RawIOBase):
+    """
+    raw io stream over an object with a read(size) method,
+    say botocore StreamingBody, so that it can be wrapped in
+    io.BufferedReader and read by the parsers as it is downloaded
+    """
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed and hasattr(self.stream, "close"):
+            self.stream.close()
+        super().close()
+
+
+class MappedFile(io.RawIOBase):
+    """
+    read only raw io stream over a memory-mapped file,
+    the file is closed along with the stream
+    """
+
+    def __init__(self, file_object, size):
+        super().__init__()
+        self.file_object = file_object
+        self.size = size
+        self.position = 0
+        self.mapped = None
+        if size > 0:
+            self.mapped = mmap.mmap(
+                file_object.fileno(), size, access=mmap.ACCESS_READ)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        num_bytes = max(min(len(buffer), self.size - self.position), 0)
+        if num_bytes > 0:
+            buffer[:num_bytes] = self.mapped[self.position:self.position + num_bytes]
+            self.position += num_bytes
+        return num_bytes
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            if self.mapped is not None:
+                self.mapped.close()
+            self.file_object.close()
+        super().close()
+
 
 class BaseUtils:
     """
@@ -46,6 +176,16 @@ class BaseUtils:
             "all_custom_functions": "all_custom_functions.json",
         }
 
+        # file -> content, validator and fetch time of the metadata files,
+        # kept along with the object for the invocations of a warm container
+        self.metadata_cache = {}
+        self.metadata_cache_ttl = METADATA_CACHE_TTL
+        try:
+            self.metadata_cache_ttl = float(
+                os.environ.get("METADATA_CACHE_TTL", METADATA_CACHE_TTL))
+        except ValueError as err:
+            logger.error("METADATA_CACHE_TTL invalid: %s", err)
+
     def get_dict_from_json(self, json_content) -> dict:
         """
         deserialize JSON and returns a dict
@@ -68,6 +208,46 @@ class BaseUtils:
             logger.warning("%s: %s", type(err), err)
         return None
 
+    def get_buffered_stream(self, stream, buffer_size=1024 * 1024) -> io.BufferedReader:
+        """
+        returns buffered reader over an object with a read(size) method,
+        the content is read in blocks of buffer_size as it is consumed
+        """
+        return io.BufferedReader(StreamReader(stream), buffer_size=buffer_size)
+
+    def read_data_stream(
+        self, data_stream, file_format, chosen_field_names, custom_field_names,
+        chunksize=None, parse_dtypes=None, parse_engine=None
+    ):
+        """
+        reads the data file from the gzip compressed data_stream
+        as in read_data_file and closes the stream once read,
+        or once all the chunks are read when chunksize is set
+        """
+        try:
+            output = self.read_data_file(
+                data_stream, file_format, chosen_field_names, custom_field_names,
+                chunksize=chunksize, parse_dtypes=parse_dtypes,
+                parse_engine=parse_engine
+            )
+        except Exception:
+            data_stream.close()
+            raise
+
+        if chunksize is not None and chunksize > 0:
+            return self.close_after_chunks(output, data_stream)
+        data_stream.close()
+        return output
+
+    def close_after_chunks(self, chunks, data_stream):
+        """
+        yields the chunks and closes the data_stream after the last chunk
+        """
+        try:
+            yield from chunks
+        finally:
+            data_stream.close()
+
     def upload_file(self, filename, data):
         """
         write binary file to config directory
@@ -96,6 +276,66 @@ class BaseUtils:
 
         return {}
 
+    def read_cached_metadata(self, file_to_read, fetch_function) -> dict:
+        """
+        returns the content of the metadata file from metadata_cache,
+        the file is revalidated once metadata_cache_ttl secs have passed
+        since it was fetched, a negative ttl disables the cache
+
+        fetch_function is called with the validator of the cached
+        content, say ETag, or None, and returns (content, validator),
+        where content is None when the file is not modified
+        """
+        if self.metadata_cache_ttl < 0:
+            return fetch_function(None)[0]
+
+        cached = self.metadata_cache.get(file_to_read)
+        now = time.monotonic()
+        if cached is not None and now - cached["fetched_at"] < self.metadata_cache_ttl:
+            return cached["content"]
+
+        try:
+            content, validator = fetch_function(
+                cached["validator"] if cached is not None else None)
+        except Exception as err:
+            if cached is None:
+                raise
+            logger.warning("serving cached %s, revalidation failed", file_to_read)
+            logger.warning("%s: %s", type(err), err)
+            return cached["content"]
+
+        if content is None:
+            logger.debug("not modified: %s", file_to_read)
+            cached["fetched_at"] = now
+            return cached["content"]
+
+        if content and validator is not None:
+            self.metadata_cache[file_to_read] = {
+                "content": content,
+                "validator": validator,
+                "fetched_at": now,
+            }
+        return content
+
+    def fetch_json_file(self, file_to_read, validator=None):
+        """
+        returns (dict, validator) of the JSON file, where the validator
+        is the modification time and size of the file, and the dict
+        is None when the file is not modified since validator
+        """
+        stat = os.stat(file_to_read)
+        file_validator = (stat.st_mtime_ns, stat.st_size)
+        if file_validator == validator:
+            return None, validator
+        return self.read_json_file_to_dict(file_to_read), file_validator
+
+    def read_cached_json_file(self, file_to_read) -> dict:
+        """
+        returns the dict of the JSON file from metadata_cache
+        """
+        return self.read_cached_metadata(
+            file_to_read, functools.partial(self.fetch_json_file, file_to_read))
+
     def read_all_datastream2_fields_metadata(self) -> dict:
         """
         reads all_datastream2_fields.json file,
@@ -103,7 +343,7 @@ class BaseUtils:
         from local disk and returns the dict
         """
         if "all_datastream2_fields" in self.input_configs:
-            return self.read_json_file_to_dict(
+            return self.read_cached_json_file(
                 os.path.join(
                     self.config_dir, self.input_configs["all_datastream2_fields"]
                 )
@@ -117,7 +357,7 @@ class BaseUtils:
         from local disk and returns the dict
         """
         if "all_custom_functions" in self.input_configs:
-            return self.read_json_file_to_dict(
+            return self.read_cached_json_file(
                 os.path.join(
                     self.config_dir, self.input_configs["all_custom_functions"]
                 )
@@ -131,7 +371,7 @@ class BaseUtils:
         from local disk and returns the dict
         """
         if "stream_file" in self.input_configs:
-            return self.read_json_file_to_dict(
+            return self.read_cached_json_file(
                 os.path.join(self.config_dir,
                              self.input_configs["stream_file"])
             )
@@ -144,57 +384,161 @@ class BaseUtils:
         from local disk and returns the dict
         """
         if "provision_file" in self.input_configs:
-            return self.read_json_file_to_dict(
+            return self.read_cached_json_file(
                 os.path.join(self.config_dir,
                              self.input_configs["provision_file"])
             )
         return {}
 
     def read_data_file_from_local(
-        self, filename, file_format, chosen_field_names, custom_field_names
+        self, filename, file_format, chosen_field_names, custom_field_names,
+        chunksize=None, parse_dtypes=None, parse_engine=None
     ):
         return self.read_data_file(
-            filename, file_format, chosen_field_names, custom_field_names
+            filename, file_format, chosen_field_names, custom_field_names,
+            chunksize=chunksize, parse_dtypes=parse_dtypes, parse_engine=parse_engine
         )
 
+    def get_parse_options(self, parse_dtypes) -> dict:
+        """
+        returns the dtype and na_values options of the csv parser
+        for the dict of field name -> parse dtype,
+        "-" in bigint fields is parsed as missing value
+        """
+        parse_options = {}
+        if not parse_dtypes:
+            return parse_options
+
+        dtype = {
+            field_name: "category"
+            for field_name, parse_dtype in parse_dtypes.items()
+            if parse_dtype == "category"
+        }
+        na_values = {
+            field_name: ["-"]
+            for field_name, parse_dtype in parse_dtypes.items()
+            if parse_dtype == "bigint"
+        }
+        if dtype:
+            parse_options["dtype"] = dtype
+        if na_values:
+            parse_options["na_values"] = na_values
+        return parse_options
+
+    def apply_parse_dtypes(self, output_dataframe, parse_dtypes) -> pd.DataFrame:
+        """
+        sets the dtypes of the parsed dataframe,
+        for bigint fields sets missing and non numeric values to 0
+        and keeps them as int64 when the values are whole numbers,
+        for string fields sets "-" to "others"
+        """
+        if not parse_dtypes:
+            return output_dataframe
+
+        for field_name, parse_dtype in parse_dtypes.items():
+            if field_name not in output_dataframe.columns:
+                continue
+            column = output_dataframe[field_name]
+
+            if parse_dtype == "bigint":
+                if not pd.api.types.is_numeric_dtype(column.dtype):
+                    try:
+                        # integer strings, as in JSON format streams
+                        column = column.astype("int64")
+                    except (ValueError, TypeError):
+                        column = pd.to_numeric(column, errors="coerce")
+                if column.hasnans:
+                    column = column.fillna(0)
+                # int64, not a downcast type, so that arithmetic
+                # on the column (say, epoch times) cannot overflow
+                if (pd.api.types.is_float_dtype(column.dtype)
+                        and (column % 1 == 0).all()):
+                    column = column.astype("int64")
+
+            elif parse_dtype == "category":
+                if not isinstance(column.dtype, pd.CategoricalDtype):
+                    column = column.astype("category")
+                categories = column.cat.categories
+                # "-" is renamed in the categories instead of each row
+                if "-" in categories and "others" not in categories:
+                    column = column.cat.rename_categories({"-": "others"})
+                elif "-" in categories:
+                    column = column.astype(object).replace(
+                        "-", "others").astype("category")
+
+            elif parse_dtype == "string":
+                column = column.replace("-", "others")
+
+            output_dataframe[field_name] = column
+        return output_dataframe
+
     def read_data_file(
-        self, filename_or_buffer, file_format, chosen_field_names, custom_field_names
+        self, filename_or_buffer, file_format, chosen_field_names, custom_field_names,
+        chunksize=None, parse_dtypes=None, parse_engine=None
     ) -> pd.DataFrame:
         """
         reads the content from the provided filename or iobuffer
         and returns pandas dataframe
-        """
-        output_dataframe = None
 
+        when chunksize is set, returns an iterator of
+        dataframes holding at most chunksize rows each
+
+        when parse_dtypes, dict of field name -> parse dtype, is set
+        the fields are parsed and returned in those dtypes
+
+        STRUCTURED format is parsed by pandas, or by pyarrow
+        when parse_engine is "pyarrow" and pyarrow is installed
+        """
         logger.debug("all columns in the input file... \n%s",
                      chosen_field_names)
         logger.debug("columns needed for aggregation... \n%s",
                      custom_field_names)
 
-        if file_format == "STRUCTURED":
-            output_dataframe = pd.read_csv(
-                filename_or_buffer,
-                index_col=False,
-                header=None,
-                compression="gzip",
-                names=chosen_field_names,
-                usecols=custom_field_names,
-                delimiter=" ",
-            )
-        else:
-            output_dataframe = pd.read_json(
-                filename_or_buffer, lines="True", compression="gzip", encoding="utf-8"
+        use_pyarrow = self.use_pyarrow(file_format, parse_engine)
+
+        if chunksize is not None and chunksize > 0:
+            return self.read_data_file_in_chunks(
+                filename_or_buffer, file_format, chosen_field_names,
+                custom_field_names, chunksize, parse_dtypes=parse_dtypes,
+                parse_engine="pyarrow" if use_pyarrow else None
             )
-            json_cnames = list(output_dataframe.columns.values)
-            json_new_cname = [x.lower() for x in json_cnames]
-            new_name_dic = {}
-            count = 0
-            for cname in json_cnames:
-                new_name_dic[cname] = json_new_cname[count]
-                count = count + 1
-                output_dataframe = output_dataframe.rename(
-                    columns=new_name_dic, inplace=False
+
+        output_dataframe = None
+
+        if use_pyarrow:
+            pyarrow = import_pyarrow()
+            try:
+                output_dataframe = self.read_csv_with_pyarrow(
+                    filename_or_buffer, chosen_field_names, custom_field_names,
+                    parse_dtypes
                 )
+            except pyarrow.ArrowInvalid as err:
+                # say, non integer values in bigint fields,
+                # the input is parsed again when it can be rewound
+                if not isinstance(filename_or_buffer, (str, os.PathLike)):
+                    if not (hasattr(filename_or_buffer, "seekable")
+                            and filename_or_buffer.seekable()):
+                        raise
+                    filename_or_buffer.seek(0)
+                logger.warning(
+                    "%s: %s, parsing with pandas", type(err), err)
+
+        if output_dataframe is None:
+            if file_format == "STRUCTURED":
+                output_dataframe = pd.read_csv(
+                    filename_or_buffer,
+                    index_col=False,
+                    header=None,
+                    compression="gzip",
+                    names=chosen_field_names,
+                    usecols=custom_field_names,
+                    delimiter=" ",
+                    **self.get_parse_options(parse_dtypes),
+                )
+            else:
+                output_dataframe = next(self.read_json_lines(
+                    filename_or_buffer, custom_field_names, parse_dtypes=parse_dtypes))
+        output_dataframe = self.apply_parse_dtypes(output_dataframe, parse_dtypes)
 
         # check if read properly
         logger.debug("top 5 rows... \n%s", output_dataframe.head(5))
@@ -207,3 +551,225 @@ class BaseUtils:
             logger.debug("info...\n%s", buffer.getvalue())
 
         return output_dataframe
+
+    def read_data_file_in_chunks(
+        self, filename_or_buffer, file_format, chosen_field_names, custom_field_names,
+        chunksize, parse_dtypes=None, parse_engine=None
+    ):
+        """
+        reads the content from the provided filename or iobuffer
+        and yields pandas dataframes of at most chunksize rows,
+        so that only one chunk is held in memory at a time
+        """
+        if self.use_pyarrow(file_format, parse_engine):
+            reader = contextlib.closing(self.read_csv_with_pyarrow_in_chunks(
+                filename_or_buffer, chosen_field_names, custom_field_names,
+                chunksize, parse_dtypes))
+        elif file_format == "STRUCTURED":
+            reader = pd.read_csv(
+                filename_or_buffer,
+                index_col=False,
+                header=None,
+                compression="gzip",
+                names=chosen_field_names,
+                usecols=custom_field_names,
+                delimiter=" ",
+                chunksize=chunksize,
+                **self.get_parse_options(parse_dtypes),
+            )
+        else:
+            reader = contextlib.closing(self.read_json_lines(
+                filename_or_buffer, custom_field_names, chunksize=chunksize,
+                parse_dtypes=parse_dtypes))
+
+        with reader as chunks:
+            for chunk_count, output_dataframe in enumerate(chunks, start=1):
+                output_dataframe = self.apply_parse_dtypes(
+                    output_dataframe, parse_dtypes)
+                logger.debug("chunk %s, rows: %s",
+                             chunk_count, len(output_dataframe.index))
+                yield output_dataframe
+
+    def use_pyarrow(self, file_format, parse_engine) -> bool:
+        """
+        checks if the pyarrow parse engine is selected and available
+        """
+        if file_format != "STRUCTURED" or parse_engine != "pyarrow":
+            return False
+        if import_pyarrow() is None:
+            logger.warning(
+                "parse-engine pyarrow is not installed, parsing with pandas")
+            return False
+        return True
+
+    def get_pyarrow_options(self, chosen_field_names, custom_field_names, parse_dtypes):
+        """
+        returns the read, parse and convert options of pyarrow.csv,
+        fields are typed by parse_dtypes and "-" in bigint fields
+        is parsed as missing value
+        """
+        pyarrow = import_pyarrow()
+        column_types = {}
+        for field_name, parse_dtype in (parse_dtypes or {}).items():
+            if parse_dtype == "bigint":
+                column_types[field_name] = pyarrow.int64()
+            elif parse_dtype == "category":
+                column_types[field_name] = pyarrow.dictionary(
+                    pyarrow.int32(), pyarrow.string())
+            elif parse_dtype == "string":
+                column_types[field_name] = pyarrow.string()
+
+        read_options = pyarrow.csv.ReadOptions(
+            column_names=chosen_field_names, use_threads=True)
+        parse_options = pyarrow.csv.ParseOptions(delimiter=" ")
+        convert_options = pyarrow.csv.ConvertOptions(
+            include_columns=custom_field_names,
+            column_types=column_types,
+            # null values are not applied to string fields
+            null_values=list(pyarrow.csv.ConvertOptions().null_values) + ["-"],
+        )
+        return read_options, parse_options, convert_options
+
+    def get_dataframe_from_arrow(self, table, parse_dtypes=None) -> pd.DataFrame:
+        """
+        returns dataframe of the arrow table or record batch,
+        numeric values of string fields are converted as in pd.read_csv
+        """
+        output_dataframe = table.to_pandas()
+        for field_name, parse_dtype in (parse_dtypes or {}).items():
+            if parse_dtype == "string" and field_name in output_dataframe.columns:
+                self.infer_numeric_column(output_dataframe, field_name)
+        return output_dataframe
+
+    def read_csv_with_pyarrow(
+        self, filename_or_buffer, chosen_field_names, custom_field_names,
+        parse_dtypes=None
+    ) -> pd.DataFrame:
+        """
+        reads the gzip compressed STRUCTURED content from the provided
+        filename or iobuffer with the multi-threaded pyarrow.csv reader
+        """
+        pyarrow = import_pyarrow()
+        read_options, parse_options, convert_options = self.get_pyarrow_options(
+            chosen_field_names, custom_field_names, parse_dtypes)
+        if not isinstance(filename_or_buffer, (str, os.PathLike)):
+            filename_or_buffer = UnclosedFile(filename_or_buffer)
+        with pyarrow.input_stream(filename_or_buffer, compression="gzip") as stream:
+            table = pyarrow.csv.read_csv(
+                stream,
+                read_options=read_options,
+                parse_options=parse_options,
+                convert_options=convert_options,
+            )
+        return self.get_dataframe_from_arrow(table, parse_dtypes)
+
+    def read_csv_with_pyarrow_in_chunks(
+        self, filename_or_buffer, chosen_field_names, custom_field_names,
+        chunksize, parse_dtypes=None
+    ):
+        """
+        reads the gzip compressed STRUCTURED content from the provided
+        filename or iobuffer with the pyarrow.csv streaming reader
+        and yields pandas dataframes of at most chunksize rows
+        """
+        pyarrow = import_pyarrow()
+        read_options, parse_options, convert_options = self.get_pyarrow_options(
+            chosen_field_names, custom_field_names, parse_dtypes)
+        if not isinstance(filename_or_buffer, (str, os.PathLike)):
+            filename_or_buffer = UnclosedFile(filename_or_buffer)
+        with pyarrow.input_stream(filename_or_buffer, compression="gzip") as stream:
+            reader = pyarrow.csv.open_csv(
+                stream,
+                read_options=read_options,
+                parse_options=parse_options,
+                convert_options=convert_options,
+            )
+            for batch in reader:
+                for offset in range(0, batch.num_rows, chunksize):
+                    yield self.get_dataframe_from_arrow(
+                        batch.slice(offset, chunksize), parse_dtypes)
+
+    def read_json_lines(
+        self, filename_or_buffer, custom_field_names, chunksize=None,
+        parse_dtypes=None
+    ):
+        """
+        reads the gzip compressed JSON lines from the provided filename
+        or iobuffer and yields pandas dataframes of at most chunksize
+        rows, or of all the rows when chunksize is not set
+
+        the file is decompressed as a stream and only the
+        custom_field_names are kept, matching the JSON keys
+        case-insensitively
+        """
+        field_names = [field_name.lower() for field_name in custom_field_names]
+        # values of the fields from a record, resolved from
+        # the keys of the first record and again on a mismatch
+        get_values = None
+        rows = []
+        json_loads = get_json_loads()
+
+        with gzip.open(filename_or_buffer, "rb") as json_lines:
+            for line in json_lines:
+                if not line.strip():
+                    continue
+                record = json_loads(line)
+                try:
+                    rows.append(get_values(record))
+                except (KeyError, TypeError):
+                    keys = [self.get_json_key(record, field_name)
+                            for field_name in field_names]
+                    if None not in keys:
+                        get_values = self.get_json_values_getter(keys)
+                    rows.append(tuple(record.get(key) for key in keys))
+
+                if chunksize and len(rows) == chunksize:
+                    yield self.get_dataframe_from_json_rows(
+                        rows, field_names, parse_dtypes)
+                    rows = []
+
+        if rows or not chunksize:
+            yield self.get_dataframe_from_json_rows(rows, field_names, parse_dtypes)
+
+    def get_json_key(self, record, field_name):
+        """
+        returns the key of the record matching the
+        lowercase field_name, None when not found
+        """
+        for key in record:
+            if key.lower() == field_name:
+                return key
+        return None
+
+    def get_json_values_getter(self, keys):
+        """
+        returns function that returns the tuple of values of the keys
+        """
+        if len(keys) == 1:
+            key = keys[0]
+            return lambda record: (record[key],)
+        return operator.itemgetter(*keys)
+
+    def get_dataframe_from_json_rows(self, rows, field_names, parse_dtypes=None) -> pd.DataFrame:
+        """
+        returns dataframe of the rows of field values,
+        numeric values of the fields that are not typed
+        by parse_dtypes are converted as in pd.read_json
+        """
+        output_dataframe = pd.DataFrame.from_records(rows, columns=field_names)
+        parse_dtypes = parse_dtypes or {}
+        for field_name in field_names:
+            if parse_dtypes.get(field_name) not in ["bigint", "category"]:
+                self.infer_numeric_column(output_dataframe, field_name)
+        return output_dataframe
+
+    def infer_numeric_column(self, output_dataframe, field_name):
+        """
+        converts the column of the dataframe to numeric
+        when all its values are numeric
+        """
+        try:
+            output_dataframe[field_name] = pd.to_numeric(
+                output_dataframe[field_name])
+        except (ValueError, TypeError):
+            pass
@@ -15,24 +15,76 @@
 """
 Contains functions to interact with AWS storage
 """
+import concurrent.futures
+import functools
 import io
 import logging
 import os
+import tempfile
 
 import boto3
-from aggregation_modules.utils import BaseUtils
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from aggregation_modules.utils import BaseUtils, MappedFile
 
 logger = logging.getLogger(__name__)
 
+# defaults of the ranged download of large data files,
+# objects of at least the threshold size, in bytes, are
+# downloaded in parts of part size on concurrent threads
+RANGED_GET_THRESHOLD = 64 * 1024 * 1024
+RANGED_GET_PART_SIZE = 8 * 1024 * 1024
+RANGED_GET_CONCURRENCY = 8
+
+# size of the blocks written to the download file
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+
+def get_object_size(response) -> int:
+    """
+    returns the size of the object from the response of a ranged
+    get_object, say "bytes 0-8388607/67108864" in ContentRange,
+    or the ContentLength when the whole object is returned
+    """
+    content_range = response.get("ContentRange")
+    if content_range:
+        return int(content_range.rsplit("/", 1)[-1])
+    return response.get("ContentLength", 0)
+
+
+class ChainedStreams:
+    """
+    object with a read(size) method over the streams, say the bodies
+    of the ranged requests of an object, read one after another,
+    each stream is closed once it is read
+    """
+
+    def __init__(self, streams):
+        self.streams = list(streams)
+
+    def read(self, size=-1):
+        while self.streams:
+            data = self.streams[0].read(size)
+            if data:
+                return data
+            self.streams.pop(0).close()
+        return b""
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
+        self.streams = []
+
 
 class AWSStorageContainer(BaseUtils):
     """
     Functions to read config and date from S3 storage
     """
 
-    def __init__(self):
+    def __init__(self, s3_client=None):
         """
-        init bucket name and boto3 client for s3
+        init bucket name and boto3 client for s3,
+        s3_client can be passed say, to use a local fake client
         """
         # init base class
         super().__init__()
@@ -41,12 +93,19 @@ class AWSStorageContainer(BaseUtils):
         self.metadata_bucket = None
         self.metadata_path = None
 
+        # ranged download of large data files
+        self.ranged_get_threshold = RANGED_GET_THRESHOLD
+        self.ranged_get_part_size = RANGED_GET_PART_SIZE
+        self.ranged_get_concurrency = RANGED_GET_CONCURRENCY
+
         # s3 client from boto3
-        self.s3_client = None
+        self.s3_client = s3_client
 
         # init metadata bucket and s3_client
         self.set_metadata_bucket()
-        self.set_s3_client()
+        self.set_ranged_get_config()
+        if self.s3_client is None:
+            self.set_s3_client()
 
     def set_metadata_bucket(self):
         """
@@ -61,12 +120,38 @@ class AWSStorageContainer(BaseUtils):
             )
             logger.error("%s: %s", type(err), err)
 
+    def set_ranged_get_config(self):
+        """
+        sets the threshold, part size and concurrency of the ranged
+        download from S3_RANGED_GET_THRESHOLD, S3_RANGED_GET_PART_SIZE
+        and S3_RANGED_GET_CONCURRENCY, when set
+        setting S3_RANGED_GET_THRESHOLD to -1 disables the ranged download
+        """
+        for env_name, attr_name in [
+            ("S3_RANGED_GET_THRESHOLD", "ranged_get_threshold"),
+            ("S3_RANGED_GET_PART_SIZE", "ranged_get_part_size"),
+            ("S3_RANGED_GET_CONCURRENCY", "ranged_get_concurrency"),
+        ]:
+            value = os.environ.get(env_name)
+            if value is None:
+                continue
+            try:
+                setattr(self, attr_name, int(value))
+            except ValueError as err:
+                logger.error("%s invalid: %s", env_name, value)
+                logger.error("%s: %s", type(err), err)
+
     def set_s3_client(self):
         """
         returns boto3 client for s3
+        the connection pool is shared by the threads of the ranged download
         """
         try:
-            self.s3_client = boto3.client("s3")
+            self.s3_client = boto3.client(
+                "s3",
+                config=Config(
+                    max_pool_connections=max(10, self.ranged_get_concurrency)),
+            )
         except Exception as err:
             logger.error("Error creating boto3 client for s3")
             logger.error("%s: %s", type(err), err)
@@ -90,22 +175,169 @@ class AWSStorageContainer(BaseUtils):
             logger.error("%s: %s", type(err), err)
         return response
 
-    def read_json_metadata_from_s3(self, json_file) -> dict:
+    def download_range_from_s3(self, bucket, file_to_read, etag, start, end, fileno) -> int:
         """
-        reads json_file from s3 storage
-        and return dict object
+        downloads the bytes start to end, inclusive, of the object
+        and writes them at the same offset of the file
         """
+        response = self.s3_client.get_object(
+            Bucket=bucket, Key=file_to_read, IfMatch=etag,
+            Range=f"bytes={start}-{end}")
+        return self.write_range_to_file(
+            response["Body"], file_to_read, start, end, fileno)
+
+    def write_range_to_file(self, body, file_to_read, start, end, fileno) -> int:
+        """
+        writes the body of the ranged request of the bytes start to end,
+        inclusive, of the object at the same offset of the file
+        """
+        offset = start
         try:
+            while True:
+                data = body.read(DOWNLOAD_BLOCK_SIZE)
+                if not data:
+                    break
+                os.pwrite(fileno, data, offset)
+                offset += len(data)
+        finally:
+            body.close()
 
-            if self.metadata_path is not None:
-                json_file_path = self.metadata_path + "/" + json_file
+        if offset != end + 1:
+            raise IOError(
+                f"incomplete range {start}-{end} of {file_to_read}: "
+                f"{offset - start} bytes")
+        return offset - start
 
-            json_buffer = self.read_from_s3(
-                self.metadata_bucket, json_file_path)
-            return self.get_dict_from_json(json_buffer)
+    def download_ranges_from_s3(self, bucket, file_to_read, size, etag,
+                                first_part=None) -> MappedFile:
+        """
+        downloads the object in parts of ranged_get_part_size
+        on ranged_get_concurrency threads into a temporary file
+        and returns the memory-mapped file, first_part is the body
+        of the already requested first part, when given
+        """
+        part_size = max(self.ranged_get_part_size, 1)
+        ranges = [
+            (start, min(start + part_size, size) - 1)
+            for start in range(0, size, part_size)
+        ]
+        logger.debug("downloading file: %s from bucket: %s in %s parts",
+                     file_to_read, bucket, len(ranges))
+
+        temp_file = tempfile.TemporaryFile()
+        try:
+            temp_file.truncate(size)
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max(self.ranged_get_concurrency, 1)) as executor:
+                futures = []
+                if first_part is not None:
+                    start, end = ranges.pop(0)
+                    futures.append(executor.submit(
+                        self.write_range_to_file, first_part, file_to_read,
+                        start, end, temp_file.fileno()))
+                futures.extend(
+                    executor.submit(
+                        self.download_range_from_s3, bucket, file_to_read,
+                        etag, start, end, temp_file.fileno())
+                    for start, end in ranges
+                )
+                for future in futures:
+                    future.result()
+            return MappedFile(temp_file, size)
+        except Exception:
+            temp_file.close()
+            raise
+
+    def open_data_file_from_s3(self, bucket, file_to_read):
+        """
+        returns readable file object of the data file, the first
+        ranged_get_part_size bytes are requested with a ranged GET that
+        also gives the size of the object, objects of at least
+        ranged_get_threshold bytes are then downloaded with concurrent
+        ranged requests of the other parts, the smaller objects are streamed
+        """
+        if self.s3_client is None:
+            self.set_s3_client()
+
+        logger.debug("reading file: %s from bucket: %s",
+                     file_to_read, bucket)
+        if self.ranged_get_threshold < 0:
+            response = self.s3_client.get_object(Bucket=bucket, Key=file_to_read)
+            return self.get_buffered_stream(response["Body"])
+
+        part_size = max(self.ranged_get_part_size, 1)
+        try:
+            response = self.s3_client.get_object(
+                Bucket=bucket, Key=file_to_read, Range=f"bytes=0-{part_size - 1}")
+        except ClientError as err:
+            # empty objects have no range to return
+            if err.response.get("Error", {}).get("Code") != "InvalidRange":
+                raise
+            response = self.s3_client.get_object(Bucket=bucket, Key=file_to_read)
+            return self.get_buffered_stream(response["Body"])
+
+        size = get_object_size(response)
+        if size <= part_size:
+            # the first part is the whole object
+            return self.get_buffered_stream(response["Body"])
+
+        if size >= self.ranged_get_threshold:
+            return io.BufferedReader(self.download_ranges_from_s3(
+                bucket, file_to_read, size, response["ETag"],
+                first_part=response["Body"]))
+
+        # rest of the object is streamed after the first part
+        rest = self.s3_client.get_object(
+            Bucket=bucket, Key=file_to_read, IfMatch=response["ETag"],
+            Range=f"bytes={part_size}-")
+        return self.get_buffered_stream(
+            ChainedStreams([response["Body"], rest["Body"]]))
+
+    def fetch_json_from_s3(self, bucket, file_to_read, etag=None):
+        """
+        returns (dict, ETag) of the JSON object, a conditional
+        request is made when etag is given, and the dict
+        is None when the object is not modified
+        """
+        if self.s3_client is None:
+            self.set_s3_client()
+
+        logger.debug("reading file: %s from bucket: %s", file_to_read, bucket)
+        try:
+            if etag is None:
+                response = self.s3_client.get_object(
+                    Bucket=bucket, Key=file_to_read)
+            else:
+                response = self.s3_client.get_object(
+                    Bucket=bucket, Key=file_to_read, IfNoneMatch=etag)
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") in ["304", "NotModified"]:
+                return None, etag
+            raise
+
+        json_buffer = self.get_bytes_io_buffer(response["Body"].read())
+        return self.get_dict_from_json(json_buffer), response.get("ETag")
+
+    def read_json_metadata_from_s3(self, json_file) -> dict:
+        """
+        reads json_file from s3 storage
+        and return dict object,
+        served from the cache while it is not modified,
+        read errors are logged and raised
+        """
+        json_file_path = json_file
+        if self.metadata_path is not None:
+            json_file_path = self.metadata_path + "/" + json_file
+
+        try:
+            return self.read_cached_metadata(
+                f"s3://{self.metadata_bucket}/{json_file_path}",
+                functools.partial(
+                    self.fetch_json_from_s3, self.metadata_bucket, json_file_path),
+            )
         except Exception as err:
             logger.error("%s: %s", type(err), err)
-        return {}
+            raise
 
     def read_all_datastream2_fields_metadata(self) -> dict:
         """
@@ -145,13 +377,18 @@ class AWSStorageContainer(BaseUtils):
         return self.read_json_metadata_from_s3(self.input_configs["provision_file"])
 
     def read_data_file_from_s3(
-        self, bucket, filename, file_format, chosen_field_names, custom_columns
+        self, bucket, filename, file_format, chosen_field_names, custom_columns,
+        chunksize=None, parse_dtypes=None, parse_engine=None
     ):
         """
-        read input data file and returns a dataframe
+        read input data file and returns a dataframe,
+        the object body is decompressed and parsed as it is downloaded,
+        or once downloaded in parts for the large objects
         """
 
-        data_buffer = self.read_from_s3(bucket, filename)
-        return self.read_data_file(
-            data_buffer, file_format, chosen_field_names, custom_columns
+        data_stream = self.open_data_file_from_s3(bucket, filename)
+        return self.read_data_stream(
+            data_stream, file_format, chosen_field_names, custom_columns,
+            chunksize=chunksize, parse_dtypes=parse_dtypes,
+            parse_engine=parse_engine
         )
@@ -7,6 +7,11 @@ from .common_utils import calculate_delta, create_document, query_item_from_db,
     upsert_items_into_cosmos_db
 import azure.functions as func
 
+# when "true", the data blob is downloaded by name in chunks as it is
+# parsed, instead of being read from the blob trigger input stream,
+# can be set with STREAM_DATA_BLOB application setting
+STREAM_DATA_BLOB = "false"
+
 
 def main(myblob: func.InputStream, resultdoc: func.Out[func.DocumentList]):
     logging.info(
@@ -15,7 +20,12 @@ def main(myblob: func.InputStream, resultdoc: func.Out[func.DocumentList]):
         f"Blob Size: {myblob.length} bytes"
     )
 
-    result = run_aggregations.main(None, myblob, cloud="azure")
+    azure_blob = myblob
+    if os.environ.get("STREAM_DATA_BLOB", STREAM_DATA_BLOB).lower() == "true":
+        # "<container>/<blob name>" of the data blob
+        azure_blob = myblob.name
+
+    result = run_aggregations.main(None, azure_blob, cloud="azure")
 
     ingest_data(result)
 
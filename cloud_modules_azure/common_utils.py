@@ -49,7 +49,7 @@ def update_result(result):
     logging.info(f"result >> length :{length}")
 
     for i in range(length):
-        del result[i]["unique_visitors_value"]
+        result[i].pop("unique_visitors_value", None)
     return result
 
 
@@ -65,6 +65,10 @@ def upsert_items_into_cosmos_db(container, container_name, result):
     for i in range(length):
 
         unique_visitors_value = result[i].get("unique_visitors_value")
+        if unique_visitors_value is None:
+            # unique visitors are not listed, say for
+            # hashed unique-visitor-mode
+            continue
         logline_date = datetime.datetime.fromtimestamp(result[i].get("start_timestamp")).date().isoformat()
 
         for item in unique_visitors_value:
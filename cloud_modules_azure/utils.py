@@ -16,12 +16,15 @@
 Contains functions to interact with Azure Blob
 """
 
+import functools
 import io
 import logging
 import os
 
 from aggregation_modules.utils import BaseUtils
 
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
 from azure.storage.blob import BlobServiceClient
 
 logger = logging.getLogger(__name__)
@@ -41,6 +44,8 @@ class AzureStorageContainer(BaseUtils):
 
         # Create BlobServiceClient from a Connection String
         self.blob_service_client_for_metadata = None
+        # created on first read of a data blob by name
+        self.blob_service_client_for_data = None
         self.connect_info = {}
 
         # Init Container Clients to read metadata
@@ -66,6 +71,40 @@ class AzureStorageContainer(BaseUtils):
             logger.error("%s: %s", type(err), err)
         return None
 
+    def set_data_blob_service_client(self):
+        """
+        sets client to read the data blobs, from the
+        connection string of the blob trigger
+        """
+        try:
+            self.connect_info["azure_data_storage_connectionstring"] = os.getenv(
+                'AzureDataStorageConnectionString')
+            self.blob_service_client_for_data = (
+                BlobServiceClient.from_connection_string(
+                    self.connect_info["azure_data_storage_connectionstring"]
+                )
+            )
+        except Exception as err:
+            logger.error("%s: %s", type(err), err)
+
+    def open_stream_from_data_blob(self, blob_path) -> io.BufferedReader:
+        """
+        returns a buffered stream of the data blob "<container>/<blob name>",
+        say the name of the blob trigger input, that is downloaded
+        in chunks as it is read instead of being held in memory
+        """
+        if self.blob_service_client_for_data is None:
+            self.set_data_blob_service_client()
+
+        container_name, blob_name = blob_path.split("/", 1)
+        blob_client = self.blob_service_client_for_data.get_blob_client(
+            container=container_name,
+            blob=blob_name
+        )
+        logger.debug("streaming blob: %s from container: %s",
+                     blob_name, container_name)
+        return self.get_buffered_stream(blob_client.download_blob())
+
     def read_from_blob(self, file_name) -> io.BytesIO:
         """
         reads the file_name from blob
@@ -86,19 +125,44 @@ class AzureStorageContainer(BaseUtils):
             logger.error("%s: %s", type(err), err)
         return None
 
+    def fetch_json_from_blob(self, file_name, etag=None):
+        """
+        returns (dict, ETag) of the JSON blob, a conditional
+        request is made when etag is given, and the dict
+        is None when the blob is not modified
+        """
+        if self.blob_service_client_for_metadata is None:
+            self.set_blob_service_client()
+
+        blob_client = self.blob_service_client_for_metadata.get_blob_client(
+            container=self.connect_info["metadata_container_name"],
+            blob=file_name
+        )
+        try:
+            if etag is None:
+                download_stream = blob_client.download_blob()
+            else:
+                download_stream = blob_client.download_blob(
+                    etag=etag, match_condition=MatchConditions.IfModified)
+        except ResourceNotModifiedError:
+            return None, etag
+
+        json_buffer = self.get_bytes_io_buffer(download_stream.readall())
+        return self.get_dict_from_json(json_buffer), download_stream.properties.etag
+
     def read_json_metadata_from_blob(self, json_file) -> dict:
         """
         read json file from blob storage
-        and return dict object
+        and return dict object,
+        served from the cache while it is not modified,
+        read errors are logged and raised
         """
         try:
-            json_buffer = self.read_from_blob(json_file)
-            # return json.loads(json_content)
-            return self.get_dict_from_json(json_buffer)
-
+            return self.read_cached_metadata(
+                json_file, functools.partial(self.fetch_json_from_blob, json_file))
         except Exception as err:
             logger.error("%s: %s", type(err), err)
-        return {}
+            raise
 
     def read_all_datastream2_fields_metadata(self) -> dict:
         """
@@ -138,15 +202,25 @@ class AzureStorageContainer(BaseUtils):
         return self.read_json_metadata_from_blob(self.input_configs["provision_file"])
 
     def read_data_file_from_azure_blob(
-        self, filename, file_format, chosen_field_names, custom_columns
+        self, filename, file_format, chosen_field_names, custom_columns,
+        chunksize=None, parse_dtypes=None, parse_engine=None
     ):
         """
         reads data file from azure blob store
         and returns pandas dataframe
+
+        filename is the func.InputStream of the blob trigger, that is
+        read by the parser as is, or the "<container>/<blob name>"
+        of a data blob, that is downloaded in chunks as it is parsed
         """
 
-        data_buffer = self.get_bytes_io_buffer(filename.read())
+        if isinstance(filename, str):
+            data_stream = self.open_stream_from_data_blob(filename)
+        else:
+            data_stream = self.get_buffered_stream(filename)
 
-        return self.read_data_file(
-            data_buffer, file_format, chosen_field_names, custom_columns
+        return self.read_data_stream(
+            data_stream, file_format, chosen_field_names, custom_columns,
+            chunksize=chunksize, parse_dtypes=parse_dtypes,
+            parse_engine=parse_engine
         )
@@ -1,9 +1,11 @@
 import logging
 import os
-import azure.cosmos.cosmos_client as cosmos_client
 
 
 def get_cosmos_db_connection():
+    # imported only on the cosmos path
+    import azure.cosmos.cosmos_client as cosmos_client
+
     cosmos_db_end_point = os.environ["COSMOS_DB_ENDPOINT"]
     cosmos_db_primary_key = os.environ["COSMOS_DB_PRIMARY_KEY"]
     cosmos_db_database_name = os.environ["COSMOS_DATABASE_NAME"]
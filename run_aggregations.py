@@ -19,14 +19,22 @@ Main Module
 # TODO: add more info
 
 import argparse
+import concurrent.futures
+import glob
 import textwrap
 import logging
 import time
 import json
 import os
+import urllib.parse
 
 from aggregation_modules.aggregator import Aggregator
 
+logger = logging.getLogger(__name__)
+
+# state of the batch worker process, set by init_batch_worker
+BATCH_WORKER = {}
+
 
 def parse_inputs() -> dict:
     """
@@ -69,6 +77,66 @@ def parse_inputs() -> dict:
         ),
     )
 
+    parser.add_argument(
+        "--show-plan",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            print the aggregation plan compiled from
+            provision.json instead of aggregating the input file.
+            \n"""
+        ),
+    )
+
+    parser.add_argument(
+        "--flush-state",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            print the results of all the intervals in the state store
+            of provision.json "state-store-dir", final or not, and
+            remove them from the store instead of aggregating the input file.
+            \n"""
+        ),
+    )
+
+    parser.add_argument(
+        "--batch",
+        default=None,
+        type=str,
+        help=textwrap.dedent(
+            """\
+            specify a directory of gz files, a glob pattern, say
+            "logs/2024-01-*/*.gz", or a manifest file listing an
+            input file per line, to aggregate instead of --input.
+            results of the same interval are merged across the files.
+            \n"""
+        ),
+    )
+
+    parser.add_argument(
+        "--skip-failed",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            log and skip the --batch files that fail to aggregate,
+            instead of failing the run after the other files.
+            \n"""
+        ),
+    )
+
+    parser.add_argument(
+        "--workers",
+        default=os.cpu_count(),
+        type=int,
+        help=textwrap.dedent(
+            """\
+            number of processes aggregating the --batch files.
+            (default: %(default)s)
+            \n"""
+        ),
+    )
+
     args, _ = parser.parse_known_args()
     return vars(args)
 
@@ -100,6 +168,141 @@ def init_logging(log_level):
     return logger
 
 
+def get_batch_input_files(batch) -> list:
+    """
+    returns the list of input files of the batch, that is a directory
+    of gz files, a glob pattern, or a manifest file listing an input
+    file per line, relative to the manifest, lines starting with # are
+    skipped
+    """
+    if os.path.isdir(batch):
+        return sorted(glob.glob(os.path.join(batch, "*.gz")))
+
+    if os.path.isfile(batch) and not batch.endswith(".gz"):
+        manifest_dir = os.path.dirname(os.path.abspath(batch))
+        with open(batch, "r", encoding="utf-8") as manifest:
+            return [
+                os.path.join(manifest_dir, line.strip())
+                for line in manifest
+                if line.strip() and not line.lstrip().startswith("#")
+            ]
+
+    return sorted(glob.glob(batch, recursive=True))
+
+
+def init_batch_worker(log_level):
+    """
+    initializes the batch worker process with
+    an Aggregator to aggregate the input files
+    """
+    init_logging(log_level)
+    obj = Aggregator()
+    obj.read_metadata()
+    BATCH_WORKER["aggregator"] = obj
+
+
+def aggregate_batch_file(input_file) -> tuple:
+    """
+    aggregates the input file in the batch worker process and
+    returns its interval accumulators and number of rows
+    """
+    accumulators = {}
+    rows = BATCH_WORKER["aggregator"].accumulate_input_file(
+        accumulators, input_file)
+    return accumulators, rows
+
+
+def run_batch(obj, batch, workers, log_level, skip_failed=False) -> list:
+    """
+    aggregates the input files of the batch on a process pool of workers
+    and merges the results of the same interval into the result_map,
+    the throughput is logged in rows/sec and MB/sec of the input files.
+    when any file fails to aggregate, RuntimeError naming the failed
+    files is raised after all the files are done, unless skip_failed
+    """
+    input_files = get_batch_input_files(batch)
+    if not input_files:
+        logger.warning("no input files found: %s", batch)
+        return []
+
+    logger.info("aggregating %s input files on %s workers",
+                len(input_files), workers)
+    start_time = time.monotonic()
+    accumulators = {}
+    rows = 0
+    input_bytes = 0
+    aggregated_files = 0
+    failed_files = []
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max(workers, 1),
+        initializer=init_batch_worker,
+        initargs=(log_level,),
+    ) as executor:
+        futures = {
+            executor.submit(aggregate_batch_file, input_file): input_file
+            for input_file in input_files
+        }
+        for future in concurrent.futures.as_completed(futures):
+            input_file = futures[future]
+            try:
+                file_accumulators, file_rows = future.result()
+            except Exception as err:
+                logger.error("aggregating %s failed", input_file)
+                logger.error("%s: %s", type(err), err)
+                failed_files.append(input_file)
+                continue
+
+            obj.merge_accumulators(accumulators, file_accumulators)
+            rows += file_rows
+            input_bytes += os.path.getsize(input_file)
+            aggregated_files += 1
+            logger.debug("aggregated %s: %s rows", input_file, file_rows)
+
+    elapsed_time = max(time.monotonic() - start_time, 1e-9)
+    input_mb = input_bytes / (1024 * 1024)
+    logger.info(
+        "aggregated %s of %s files, %s rows, %.1f MB in %.2f secs: "
+        "%.0f rows/sec, %.2f MB/sec",
+        aggregated_files, len(input_files), rows, input_mb, elapsed_time,
+        rows / elapsed_time, input_mb / elapsed_time,
+    )
+
+    if failed_files and not skip_failed:
+        raise RuntimeError(
+            f"{len(failed_files)} of {len(input_files)} files failed to "
+            f"aggregate: {', '.join(sorted(failed_files))}")
+
+    # files are completed in any order
+    return obj.finalize_accumulators(accumulators, in_time_order=True)
+
+
+def get_aws_input_files(aws_event) -> list:
+    """
+    returns list of (object key, bucket name) of all the records of the
+    S3 event notification, or of the S3 event notifications in the
+    body of SQS messages, or in SNS notifications
+    """
+    if "Records" not in aws_event and "Message" in aws_event:
+        # SNS notification delivered to SQS
+        aws_event = json.loads(aws_event["Message"])
+
+    input_files = []
+    for record in aws_event.get("Records", []):
+        if "s3" in record:
+            # object keys are URL encoded in the event
+            input_files.append((
+                urllib.parse.unquote_plus(record["s3"]["object"]["key"]),
+                record["s3"]["bucket"]["name"],
+            ))
+        elif "body" in record:
+            input_files.extend(get_aws_input_files(json.loads(record["body"])))
+        elif "Sns" in record:
+            input_files.extend(get_aws_input_files(
+                json.loads(record["Sns"]["Message"])))
+    return input_files
+
+
 def main(aws_event, azure_blob, cloud=None):
     """
     main function
@@ -119,6 +322,20 @@ def main(aws_event, azure_blob, cloud=None):
     logger.debug("read metadata files...")
     obj.read_metadata()
 
+    if params["show_plan"]:
+        # list the work the provision file will do
+        return obj.aggregation_plan.describe()
+
+    if params["flush_state"]:
+        # emit the intervals held in the state store
+        return obj.flush_state_store()
+
+    if cloud is None and params["batch"] is not None:
+        # aggregate many local files
+        logger.debug("read batch input files...")
+        return run_batch(obj, params["batch"], params["workers"],
+                         params["loglevel"], params["skip_failed"])
+
     # set input data
     input_file = None
     input_bucket = None
@@ -128,8 +345,18 @@ def main(aws_event, azure_blob, cloud=None):
         input_file = params["input"]
 
     if cloud == "aws":
-        input_bucket = aws_event["Records"][0]["s3"]["bucket"]["name"]
-        input_file = aws_event["Records"][0]["s3"]["object"]["key"]
+        input_files = get_aws_input_files(aws_event)
+        if not input_files:
+            logger.warning("no S3 objects in the event")
+            return []
+
+        if len(input_files) > 1:
+            # batched event, the results of the
+            # records are merged by interval
+            logger.debug("process %s input files...", len(input_files))
+            return obj.process_input_files(input_files)
+
+        input_file, input_bucket = input_files[0]
 
     if cloud == "azure":
         input_file = azure_blob
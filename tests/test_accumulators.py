@@ -0,0 +1,148 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+results of an interval split across input files, merged by their
+partial state, compared with the single pass aggregation plan
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregation_modules.accumulators import IntervalAccumulator, merge_results
+from aggregation_modules.aggregation_plan import AggregationPlan
+from aggregation_modules.provision_parser import ProvisionMetadata
+
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), "..", "configs")
+
+USER_AGENTS = [
+    "Mozilla/5.0%20(Windows%20NT%2010.0;%20Win64;%20x64)%20AppleWebKit/537.36"
+    "%20(KHTML,%20like%20Gecko)%20Chrome/87.0.4280.66%20Safari/537.36",
+    "Mozilla/5.0%20(iPhone;%20CPU%20iPhone%20OS%2014_2%20like%20Mac%20OS%20X)"
+    "%20AppleWebKit/605.1.15%20(KHTML,%20like%20Gecko)%20Version/14.0.1"
+    "%20Mobile/15E148%20Safari/604.1",
+    "curl/7.64.1",
+    "-",
+]
+
+
+def get_provision_metadata(unique_visitor_mode) -> ProvisionMetadata:
+    """
+    returns the provision metadata of all the basic aggregates
+    and custom functions, with the partial state in the results
+    """
+    with open(os.path.join(CONFIG_DIR, "all_custom_functions.json")) as json_file:
+        all_custom_functions = json.load(json_file)
+    provision_metadata = ProvisionMetadata()
+    provision_metadata.populate_fields({
+        "aggregation-interval": 300,
+        "bytes": ["min", "max", "sum", "count", "mean", "median", "variance", "any"],
+        "turnaroundtimemsec": ["median", "variance"],
+        "reqpath": ["unique_counts"],
+        "custom-functions": list(all_custom_functions),
+        "unique-visitor-mode": unique_visitor_mode,
+        "partial-state": True,
+    }, all_custom_functions)
+    return provision_metadata
+
+
+def get_interval_dataframe(rows=3000, seed=1) -> pd.DataFrame:
+    """
+    returns the rows of a single interval
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "bytes": rng.integers(0, 100000, rows),
+        "totalbytes": rng.integers(0, 200000, rows),
+        "turnaroundtimemsec": rng.lognormal(3, 1, rows).astype("int64"),
+        "statuscode": rng.choice([200, 206, 304, 404, 503], rows),
+        "cachestatus": rng.choice([0, 1], rows),
+        "cacherefreshsrc": rng.choice(["origin", "peer", "others"], rows),
+        "reqpath": [f"p/{value}" for value in rng.integers(0, 200, rows)],
+        "ua": rng.choice(USER_AGENTS, rows),
+        "cliip": [f"10.0.0.{value}" for value in rng.integers(0, 120, rows)],
+    })
+
+
+def get_file_results(provision_metadata, dataframe, splits) -> list:
+    """
+    returns the results of the interval from each of the input
+    files, the dataframe split at the rows in splits
+    """
+    results = []
+    for start, end in zip([0, *splits], [*splits, len(dataframe)]):
+        accumulator = IntervalAccumulator(provision_metadata)
+        accumulator.update(dataframe.iloc[start:end])
+        results.append({
+            "start_timestamp": 1606768500,
+            **accumulator.finalize(),
+            "partial_state": accumulator.serialize(),
+        })
+    return results
+
+
+def check_result(result, expected):
+    """
+    checks the merged result against the single pass result
+    """
+    unique_visitors = result.pop("unique_visitors_value", None)
+    expected_unique_visitors = expected.pop("unique_visitors_value", None)
+    if expected_unique_visitors is not None:
+        assert {tuple(value) for value in unique_visitors} == set(
+            expected_unique_visitors)
+
+    assert result.keys() == expected.keys()
+    for key, value in expected.items():
+        if isinstance(value, float):
+            assert result[key] == pytest.approx(value), key
+        else:
+            assert result[key] == value, key
+
+
+@pytest.mark.parametrize("unique_visitor_mode", ["list", "hashed", "hll"])
+def test_merged_results(unique_visitor_mode):
+    provision_metadata = get_provision_metadata(unique_visitor_mode)
+    dataframe = get_interval_dataframe()
+    expected = AggregationPlan(provision_metadata).run(dataframe)
+
+    results = get_file_results(provision_metadata, dataframe, [1, 1000, 1001, 2500])
+    # the results of another interval are kept apart
+    results.append({**results[0], "start_timestamp": 1606768800})
+    merged = merge_results(results, provision_metadata)
+
+    assert [result["start_timestamp"] for result in merged] == [1606768500, 1606768800]
+    result = merged[0]
+    result.pop("start_timestamp")
+    result.pop("partial_state")
+    check_result(result, expected)
+
+
+@pytest.mark.parametrize("unique_visitor_mode", ["list", "hashed", "hll"])
+def test_serialize_round_trip(unique_visitor_mode):
+    provision_metadata = get_provision_metadata(unique_visitor_mode)
+    accumulator = IntervalAccumulator(provision_metadata)
+    accumulator.update(get_interval_dataframe())
+
+    deserialized = IntervalAccumulator.deserialize(
+        accumulator.serialize(), provision_metadata)
+    check_result(deserialized.finalize(), accumulator.finalize())
+
+    # the deserialized state is merged as the original one
+    merged = IntervalAccumulator.deserialize(
+        deserialized.serialize(), provision_metadata).merge(deserialized)
+    assert merged.finalize()["bytes_count"] == 2 * len(get_interval_dataframe())
@@ -0,0 +1,59 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+bigint fields of a parsed chunk, say, a chunk where
+every reqtimesec is "-", rounded off to intervals
+"""
+
+import gzip
+import io
+
+import pandas as pd
+
+from aggregation_modules.custom_functions import convert_time_to_interval
+from aggregation_modules.utils import BaseUtils
+
+
+def read_chunk(lines) -> pd.DataFrame:
+    """
+    parses the lines of reqtimesec and turnaroundtimemsec
+    as bigint fields
+    """
+    buffer = io.BytesIO(gzip.compress("\n".join(lines).encode()))
+    return BaseUtils().read_data_file(
+        buffer, "STRUCTURED", ["reqtimesec", "turnaroundtimemsec"],
+        ["reqtimesec", "turnaroundtimemsec"],
+        parse_dtypes={"reqtimesec": "bigint", "turnaroundtimemsec": "bigint"},
+    )
+
+
+def test_missing_epoch_times():
+    dataframe = read_chunk(["- 5"] * 10)
+    assert dataframe["reqtimesec"].dtype == "int64"
+    intervals = convert_time_to_interval(dataframe["reqtimesec"], delta=300)
+    assert intervals.tolist() == [0] * 10
+
+
+def test_epoch_times():
+    dataframe = read_chunk(["1606768884 5", "1606769050 -", "x 7"])
+    assert dataframe["turnaroundtimemsec"].tolist() == [5, 0, 7]
+    intervals = convert_time_to_interval(dataframe["reqtimesec"], delta=300)
+    assert intervals.tolist() == [1606768800, 1606768800, 0]
+
+
+def test_small_integer_epoch_times():
+    intervals = convert_time_to_interval(
+        pd.Series([0, 100], dtype="int8"), delta=300)
+    assert intervals.tolist() == [0, 0]
@@ -0,0 +1,132 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+data files read from S3 with a stub client, in ranged parts
+or streamed, compared with the object
+"""
+
+import hashlib
+import io
+import random
+import threading
+
+import pytest
+
+pytest.importorskip("boto3")
+
+from botocore.exceptions import ClientError  # noqa: E402
+
+from cloud_modules_aws.utils import AWSStorageContainer  # noqa: E402
+
+PART_SIZE = 1000
+
+
+class StubS3Client:
+    """
+    get_object of a single object, answering Range and IfMatch
+    as S3 does, the body of the range short_range is cut short
+    """
+
+    def __init__(self, data, short_range=None):
+        self.data = data
+        self.etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        self.short_range = short_range
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        with self.lock:
+            self.ranges.append(Range)
+        if IfMatch is not None and IfMatch != self.etag:
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "GetObject")
+
+        response = {"ETag": self.etag}
+        body = self.data
+        if Range is not None:
+            if not self.data:
+                raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+            start, end = Range[len("bytes="):].split("-")
+            start = int(start)
+            end = min(int(end) if end else len(self.data) - 1, len(self.data) - 1)
+            response["ContentRange"] = f"bytes {start}-{end}/{len(self.data)}"
+            body = self.data[start:end + 1]
+            if Range == self.short_range:
+                body = body[:-1]
+        response["Body"] = io.BytesIO(body)
+        response["ContentLength"] = len(body)
+        return response
+
+
+def open_data_file(data, threshold, short_range=None):
+    """
+    returns the file object opened from the stub client
+    and the client
+    """
+    s3_client = StubS3Client(data, short_range)
+    storage = AWSStorageContainer(s3_client=s3_client)
+    storage.ranged_get_threshold = threshold
+    storage.ranged_get_part_size = PART_SIZE
+    storage.ranged_get_concurrency = 4
+    return storage.open_data_file_from_s3("bucket", "key"), s3_client
+
+
+def get_data(size) -> bytes:
+    return random.Random(size).randbytes(size)
+
+
+@pytest.mark.parametrize("size", [PART_SIZE + 1, 5 * PART_SIZE, 5 * PART_SIZE + 7])
+def test_parts_reassembled(size):
+    data = get_data(size)
+    data_file, s3_client = open_data_file(data, threshold=PART_SIZE)
+    with data_file:
+        assert data_file.read() == data
+
+    parts = -(-size // PART_SIZE)
+    assert len(s3_client.ranges) == parts
+    assert sorted(s3_client.ranges) == sorted(
+        f"bytes={start}-{min(start + PART_SIZE, size) - 1}"
+        for start in range(0, size, PART_SIZE))
+
+
+def test_short_part():
+    data = get_data(5 * PART_SIZE)
+    with pytest.raises(IOError, match="incomplete range"):
+        open_data_file(data, threshold=PART_SIZE,
+                       short_range=f"bytes={2 * PART_SIZE}-{3 * PART_SIZE - 1}")
+
+
+@pytest.mark.parametrize("size", [0, 10, PART_SIZE, PART_SIZE + 1, 5 * PART_SIZE])
+def test_streamed_below_threshold(size):
+    data = get_data(size)
+    data_file, s3_client = open_data_file(data, threshold=10 * PART_SIZE)
+    with data_file:
+        assert data_file.read() == data
+
+    if size == 0:
+        # no range of an empty object, read again without one
+        assert s3_client.ranges == [f"bytes=0-{PART_SIZE - 1}", None]
+    elif size <= PART_SIZE:
+        assert s3_client.ranges == [f"bytes=0-{PART_SIZE - 1}"]
+    else:
+        # the rest of the object after the first part
+        assert s3_client.ranges == [f"bytes=0-{PART_SIZE - 1}", f"bytes={PART_SIZE}-"]
+
+
+def test_ranged_get_disabled():
+    data = get_data(5 * PART_SIZE)
+    data_file, s3_client = open_data_file(data, threshold=-1)
+    with data_file:
+        assert data_file.read() == data
+    assert s3_client.ranges == [None]
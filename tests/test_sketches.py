@@ -0,0 +1,135 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+accuracy, merge and serialization of the t-digest
+and HyperLogLog sketches
+"""
+
+import math
+
+import numpy as np
+import pytest
+
+from aggregation_modules.sketches import HyperLogLog, TDigest
+
+QUANTILES = [0.01, 0.25, 0.5, 0.9, 0.99, 0.999]
+
+
+def get_lognormal_values(seed, size=200000) -> np.ndarray:
+    """
+    returns skewed values with a long tail, say turnaround times
+    """
+    return np.random.default_rng(seed).lognormal(3, 1, size)
+
+
+def get_rank_errors(sketch, values) -> list:
+    """
+    returns the distance of the rank of each estimated
+    quantile to the quantile
+    """
+    sorted_values = np.sort(values)
+    return [
+        abs(np.searchsorted(sorted_values, sketch.quantile(q)) / len(values) - q)
+        for q in QUANTILES
+    ]
+
+
+def get_merged_digest(values, parts=40) -> TDigest:
+    """
+    returns the digest of values merged from the digests of its parts
+    """
+    sketch = TDigest()
+    for part in np.array_split(values, parts):
+        sketch.merge(TDigest().add_values(part))
+    return sketch
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_quantile_accuracy(seed):
+    values = get_lognormal_values(seed)
+    for sketch in [TDigest().add_values(values), get_merged_digest(values)]:
+        assert max(get_rank_errors(sketch, values)) < 0.002
+        assert len(sketch.means) <= 2 * sketch.compression
+        # the tail is kept in small centroids
+        assert sketch.quantile(0.999) == pytest.approx(
+            np.quantile(values, 0.999), rel=0.03)
+        assert sketch.weights[0] == sketch.weights[-1] == 1
+        assert sketch.quantile(0) == values.min()
+        assert sketch.quantile(1) == values.max()
+
+
+def test_repeated_values():
+    values = np.repeat(np.arange(10, dtype=np.float64), 1000)
+    sketch = TDigest().add_values(values)
+    assert sketch.count() == len(values)
+    assert sketch.quantile(0.55) == pytest.approx(5, abs=0.5)
+    assert math.isnan(TDigest().add_values([math.nan]).quantile(0.5))
+
+
+def test_digest_serialize():
+    sketch = get_merged_digest(get_lognormal_values(1))
+    deserialized = TDigest.deserialize(sketch.serialize())
+    assert deserialized.compression == sketch.compression
+    assert deserialized.count() == sketch.count()
+    assert [deserialized.quantile(q) for q in QUANTILES] == [
+        sketch.quantile(q) for q in QUANTILES]
+
+
+def test_digest_compression():
+    with pytest.raises(ValueError):
+        TDigest(TDigest.MIN_COMPRESSION - 1)
+    with pytest.raises(ValueError):
+        TDigest(TDigest.MAX_COMPRESSION + 1)
+
+
+def get_hashes(seed, size) -> np.ndarray:
+    return np.random.default_rng(seed).integers(
+        0, np.iinfo(np.uint64).max, size, dtype=np.uint64, endpoint=True)
+
+
+@pytest.mark.parametrize("precision, size", [(12, 100), (12, 200000), (14, 50000), (4, 10000)])
+def test_hll_accuracy(precision, size):
+    sketch = HyperLogLog(precision).add_hashes(get_hashes(precision, size))
+    # repeated hashes are counted once
+    sketch.add_hashes(get_hashes(precision, size)[:size // 2])
+    standard_error = 1.04 / math.sqrt(1 << precision)
+    assert abs(sketch.count() - size) <= 4 * standard_error * size
+
+
+def test_hll_merge():
+    hashes = get_hashes(1, 30000)
+    sketch = HyperLogLog().add_hashes(hashes[:20000])
+    other = HyperLogLog().add_hashes(hashes[10000:])
+    merged = HyperLogLog.deserialize(sketch.serialize()).merge(other)
+    np.testing.assert_array_equal(
+        merged.registers, HyperLogLog().add_hashes(hashes).registers)
+
+    with pytest.raises(ValueError):
+        sketch.merge(HyperLogLog(14))
+
+
+def test_hll_serialize():
+    sketch = HyperLogLog(10).add_hashes(get_hashes(2, 5000))
+    deserialized = HyperLogLog.deserialize(sketch.serialize())
+    assert deserialized.precision == 10
+    assert deserialized.count() == sketch.count()
+    assert HyperLogLog.deserialize(HyperLogLog().serialize()).count() == 0
+
+
+def test_hll_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(HyperLogLog.MIN_PRECISION - 1)
+    with pytest.raises(ValueError):
+        HyperLogLog(HyperLogLog.MAX_PRECISION + 1)
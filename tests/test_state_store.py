@@ -0,0 +1,131 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+fold, finalize, late data and flush cycle of the interval
+state store over input files that overlap the intervals
+"""
+
+import json
+import logging
+import os
+
+import pandas as pd
+
+from aggregation_modules.accumulators import IntervalAccumulator
+from aggregation_modules.provision_parser import ProvisionMetadata
+from aggregation_modules.state_store import IntervalStateStore
+
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), "..", "configs")
+
+
+def get_provision_metadata(**options) -> ProvisionMetadata:
+    """
+    returns the provision metadata of 300 secs intervals
+    with the sum and count of bytes and the total hits
+    """
+    with open(os.path.join(CONFIG_DIR, "all_custom_functions.json")) as json_file:
+        all_custom_functions = json.load(json_file)
+    provision_metadata = ProvisionMetadata()
+    provision_metadata.populate_fields({
+        "aggregation-interval": 300,
+        "bytes": ["sum", "count"],
+        "custom-functions": ["get_total_hits"],
+        **options,
+    }, all_custom_functions)
+    return provision_metadata
+
+
+def get_accumulators(provision_metadata, rows) -> dict:
+    """
+    returns the interval accumulators of an input file,
+    rows of (reqtimesec, bytes)
+    """
+    dataframe = pd.DataFrame(rows, columns=["reqtimesec", "bytes"])
+    accumulators = {}
+    for agg_timestamp, df_ctxt in dataframe.groupby(dataframe["reqtimesec"] // 300 * 300):
+        accumulators[int(agg_timestamp)] = IntervalAccumulator(provision_metadata)
+        accumulators[int(agg_timestamp)].update(df_ctxt)
+    return accumulators
+
+
+def fold(store, provision_metadata, rows) -> dict:
+    """
+    folds an input file into the store and returns
+    the results of the final intervals
+    """
+    final_accumulators = store.fold(
+        "1234", get_accumulators(provision_metadata, rows),
+        provision_metadata.watermark_delay)
+    return {
+        agg_timestamp: accumulator.finalize()
+        for agg_timestamp, accumulator in final_accumulators.items()
+    }
+
+
+def test_fold_finalize_and_flush(tmp_path, caplog):
+    provision_metadata = get_provision_metadata()
+    store = IntervalStateStore(str(tmp_path), provision_metadata)
+    try:
+        with caplog.at_level(logging.WARNING):
+            # each file holds the end of one interval and the start of the next
+            assert fold(store, provision_metadata, [(10, 1), (290, 2), (310, 4)]) == {}
+            # interval 0 is final once the watermark is two intervals past it
+            results = fold(store, provision_metadata, [(295, 8), (590, 16), (610, 32)])
+            assert results == {0: {"bytes_sum": 11, "bytes_count": 3, "total_hits": 3}}
+            results = fold(store, provision_metadata, [(599, 64), (900, 128)])
+            assert results == {300: {"bytes_sum": 84, "bytes_count": 3, "total_hits": 3}}
+        assert "late data" not in caplog.text
+
+        flushed = {
+            agg_timestamp: accumulator.finalize()
+            for agg_timestamp, accumulator in store.flush("1234").items()
+        }
+        assert flushed == {
+            600: {"bytes_sum": 32, "bytes_count": 1, "total_hits": 1},
+            900: {"bytes_sum": 128, "bytes_count": 1, "total_hits": 1},
+        }
+        assert store.flush("1234") == {}
+    finally:
+        store.close()
+
+
+def test_late_data(tmp_path, caplog):
+    provision_metadata = get_provision_metadata()
+    store = IntervalStateStore(str(tmp_path), provision_metadata)
+    try:
+        fold(store, provision_metadata, [(10, 1), (310, 2)])
+        assert list(fold(store, provision_metadata, [(610, 4), (910, 8)])) == [0, 300]
+
+        # data of an interval already emitted is another result of it
+        with caplog.at_level(logging.WARNING):
+            results = fold(store, provision_metadata, [(20, 16)])
+        assert "late data" in caplog.text
+        assert results == {0: {"bytes_sum": 16, "bytes_count": 1, "total_hits": 1}}
+    finally:
+        store.close()
+
+
+def test_zero_watermark_delay(tmp_path, caplog):
+    provision_metadata = get_provision_metadata(**{"watermark-delay": 0})
+    store = IntervalStateStore(str(tmp_path), provision_metadata)
+    try:
+        assert list(fold(store, provision_metadata, [(10, 1), (310, 2)])) == [0]
+
+        # with no delay an overlapping file makes late data
+        with caplog.at_level(logging.WARNING):
+            fold(store, provision_metadata, [(295, 4), (610, 8)])
+        assert "late data" in caplog.text
+    finally:
+        store.close()
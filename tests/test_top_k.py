@@ -0,0 +1,102 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+top-k of a skewed column aggregated in chunks or at once,
+compared with the exact value_counts
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregation_modules.accumulators import ColumnAccumulator
+from aggregation_modules.custom_functions import (
+    get_top_k_from_counts,
+    get_unique_counts_from_counts,
+    get_value_counts,
+)
+
+K = 10
+
+
+def get_skewed_column(seed) -> pd.Series:
+    """
+    returns a column of 20000 paths, mildly skewed
+    over 2000 distinct values
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, 2001) ** 0.6
+    values = rng.choice(2000, 20000, p=weights / weights.sum())
+    return pd.Series([f"p/{value}" for value in values], name="reqpath")
+
+
+def accumulate_in_chunks(column, chunk_size=300) -> ColumnAccumulator:
+    """
+    folds the column into a top-k accumulator chunk by chunk
+    """
+    accumulator = ColumnAccumulator("reqpath", ["unique_counts"], top_k=K)
+    for start in range(0, len(column), chunk_size):
+        accumulator.update(column.iloc[start:start + chunk_size])
+    return accumulator
+
+
+def check_top_k(result, column):
+    """
+    checks the top-k counts and the counts of the other values
+    against the exact value counts
+    """
+    exact = column.value_counts()
+    top_k = result["reqpath"]
+    others = result["reqpath_others"]
+
+    # counts are lower bounds of the true counts
+    for value, count in top_k.items():
+        assert count <= exact[value], value
+
+    # values clearly more frequent than the k+1 th value are reported
+    for value, count in exact.iloc[:K].items():
+        if count > exact.iloc[K]:
+            assert value in top_k, value
+
+    assert sum(top_k.values()) + others == len(column)
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_chunked_top_k(seed):
+    column = get_skewed_column(seed)
+    result = accumulate_in_chunks(column).finalize()
+    check_top_k(result, column)
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_merged_top_k(seed):
+    column = get_skewed_column(seed)
+    half = len(column) // 2
+    accumulator = accumulate_in_chunks(column.iloc[:half])
+    other = ColumnAccumulator("reqpath", ["unique_counts"], top_k=K)
+    other.set_partial(accumulate_in_chunks(column.iloc[half:]).get_partial())
+    result = accumulator.merge(other).finalize()
+    check_top_k(result, column)
+
+
+def test_plan_top_k():
+    # "others", the value of "-", is a value of the column
+    # and is not summed with the counts of the other values
+    column = pd.concat([get_skewed_column(1), pd.Series(["others"] * 5000)])
+    value_counts = get_value_counts(column)
+    result = get_top_k_from_counts(value_counts, "reqpath", k=K)
+    assert result["reqpath"] == get_unique_counts_from_counts(value_counts.iloc[:K])
+    assert result["reqpath"]["others"] == 5000
+    assert result["reqpath_others"] == len(column) - sum(result["reqpath"].values())
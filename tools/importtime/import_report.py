@@ -0,0 +1,236 @@
+# Copyright 2020 Akamai Technologies, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports the import time of the entry point modules
+
+i.e It imports each module in a fresh interpreter with
+python -X importtime and summarizes the output by top level
+package and by the slowest modules, to find the imports
+that add to the cold start of the cloud functions.
+
+usage example:
+
+    python tools/importtime/import_report.py
+    python tools/importtime/import_report.py cloud_modules_aws --runs 5
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import textwrap
+
+# repository root, so that the entry point modules can be imported
+BASE_DIR = os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+
+# line of python -X importtime output,
+# "import time: <self us> | <cumulative us> | <indent><module>"
+IMPORT_TIME_LINE = re.compile(
+    r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def parse_inputs() -> dict:
+    """
+    parse the input command line arguments
+    and return dictionary
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="import_report.py",
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent(
+            """\
+            Reports the import time of the entry point modules,
+            summarized by top level package and slowest modules
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "modules",
+        nargs="*",
+        default=["run_aggregations"],
+        help=textwrap.dedent(
+            """\
+            modules to import, say cloud_modules_aws.
+            (default: run_aggregations)
+            \n"""
+        ),
+    )
+
+    parser.add_argument(
+        "--runs",
+        default=3,
+        type=int,
+        help=textwrap.dedent(
+            """\
+            number of fresh interpreters to import each module in,
+            the fastest time of each module is reported.
+            (default: %(default)s)
+            \n"""
+        ),
+    )
+
+    parser.add_argument(
+        "--top",
+        default=15,
+        type=int,
+        help=textwrap.dedent(
+            """\
+            number of packages and modules to list.
+            (default: %(default)s)
+            \n"""
+        ),
+    )
+
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            print the report as JSON.
+            \n"""
+        ),
+    )
+
+    args = parser.parse_args()
+    return vars(args)
+
+
+def measure_import_time(module) -> dict:
+    """
+    imports the module in a fresh interpreter and returns
+    dict of module -> (self, cumulative) import time in usecs
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [BASE_DIR, env.get("PYTHONPATH")]))
+
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BASE_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if completed.returncode != 0:
+        # the import error is the last line of the traceback
+        raise RuntimeError(
+            f"import {module} failed: {completed.stderr.strip().splitlines()[-1]}")
+
+    import_times = {}
+    for line in completed.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is None:
+            continue
+        self_time, cumulative_time, _, name = match.groups()
+        import_times[name] = (int(self_time), int(cumulative_time))
+    return import_times
+
+
+def get_report(module, runs, top) -> dict:
+    """
+    returns the import time report of the module,
+    with the fastest time of each module across runs
+    """
+    import_times = {}
+    for _ in range(max(runs, 1)):
+        for name, times in measure_import_time(module).items():
+            if name not in import_times:
+                import_times[name] = times
+            else:
+                import_times[name] = tuple(
+                    map(min, zip(import_times[name], times)))
+
+    # self time of each top level package
+    packages = {}
+    for name, (self_time, _) in import_times.items():
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_time
+
+    total = sum(packages.values())
+    top_packages = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    top_modules = sorted(
+        import_times.items(), key=lambda item: -item[1][1])[:top]
+
+    return {
+        "module": module,
+        "total_msec": round(total / 1000, 1),
+        "modules_imported": len(import_times),
+        "packages": [
+            {
+                "package": package,
+                "self_msec": round(self_time / 1000, 1),
+                "percent": round(100 * self_time / total, 1) if total else 0,
+            }
+            for package, self_time in top_packages
+        ],
+        "slowest_modules": [
+            {
+                "module": name,
+                "cumulative_msec": round(cumulative_time / 1000, 1),
+                "self_msec": round(self_time / 1000, 1),
+            }
+            for name, (self_time, cumulative_time) in top_modules
+        ],
+    }
+
+
+def print_report(report):
+    """
+    prints the report as text tables
+    """
+    print(f"import {report['module']}: {report['total_msec']} msec, "
+          f"{report['modules_imported']} modules")
+
+    print(f"\n  {'package':40} {'self msec':>10} {'%':>6}")
+    for package in report["packages"]:
+        print(f"  {package['package']:40} {package['self_msec']:>10} "
+              f"{package['percent']:>6}")
+
+    print(f"\n  {'module':40} {'cumul msec':>10} {'self msec':>10}")
+    for module in report["slowest_modules"]:
+        print(f"  {module['module']:40} {module['cumulative_msec']:>10} "
+              f"{module['self_msec']:>10}")
+    print()
+
+
+def main():
+    """
+    main function
+    """
+    params = parse_inputs()
+
+    reports = []
+    for module in params["modules"]:
+        try:
+            reports.append(get_report(module, params["runs"], params["top"]))
+        except RuntimeError as err:
+            print(err, file=sys.stderr)
+
+    if params["json"]:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print_report(report)
+
+    return 0 if len(reports) == len(params["modules"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())